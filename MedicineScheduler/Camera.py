@@ -0,0 +1,614 @@
+import collections
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+import time
+
+import config as CONF
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Only needed where detectQR runs
+try:
+    import cv2
+except ImportError:
+    cv2 = None
+try:
+    import zbar
+except ImportError:
+    zbar = None
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+
+# zbar ImageScanner.parse_config settings for config.SCAN_PROFILE. Density
+# is the scan line spacing in pixels: 2 halves the work and still finds
+# a sticker that fills a good part of the frame
+SCAN_PROFILES = {
+    "all": ["enable"],
+    "qr": ["disable", "qrcode.enable", "x-density=1", "y-density=1"],
+    "qr-fast": ["disable", "qrcode.enable", "x-density=2", "y-density=2"],
+}
+
+
+def configureScanner(scanner, profile):
+    for setting in SCAN_PROFILES[profile]:
+        scanner.parse_config(setting)
+
+
+# Preprocessing for ParallelDecoder: variant -> function(gray) returning
+# (image, scale), where scale maps the image's pixels back to the frame's
+SHARPEN_KERNEL = numpy.array([[0, -1, 0], [-1, 5, -1], [0, -1, 0]], numpy.float32) \
+    if numpy is not None else None
+
+PREPROCESSORS = {
+    "native": lambda gray: (gray, 1.0),
+    "half": lambda gray: (cv2.resize(gray, None, fx=0.5, fy=0.5,
+                                     interpolation=cv2.INTER_AREA), 2.0),
+    "double": lambda gray: (cv2.resize(gray, None, fx=2, fy=2,
+                                       interpolation=cv2.INTER_LINEAR), 0.5),
+    "threshold": lambda gray: (cv2.adaptiveThreshold(
+        gray, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 31, 5), 1.0),
+    "sharpen": lambda gray: (cv2.filter2D(gray, -1, SHARPEN_KERNEL), 1.0),
+}
+
+# zbar scanner of each ParallelDecoder worker process, and the shared
+# number of the frame the decoder is on
+DECODE_SCANNER = None
+DECODE_FRAME = None
+
+
+def initDecodeWorker(profile, frameNumber):
+    global DECODE_SCANNER, DECODE_FRAME
+    DECODE_SCANNER = zbar.ImageScanner()
+    configureScanner(DECODE_SCANNER, profile)
+    DECODE_FRAME = frameNumber
+
+
+def decodeVariant(variant, width, height, frame, frameNumber):
+    """
+    Worker entry point: (variant, [(data, location)]) for one preprocessed
+    copy of the frame, locations in frame pixels. Returns no symbols
+    without scanning if the decoder has moved on to a later frame.
+    """
+    if DECODE_FRAME.value != frameNumber:
+        return variant, []
+
+    gray = numpy.frombuffer(frame, numpy.uint8).reshape(height, width)
+    image, scale = PREPROCESSORS[variant](gray)
+
+    zImg = zbar.Image(image.shape[1], image.shape[0], "Y800", image.tobytes())
+    DECODE_SCANNER.scan(zImg)
+
+    return variant, [(symbol.data, [(int(x * scale), int(y * scale)) for x, y in symbol.location])
+                     for symbol in zImg]
+
+
+class ParallelDecoder(object):
+    """
+    Decodes each frame in several preprocessed variants at once on a pool
+    of processes, one core each, and takes the first variant that reads a
+    symbol. Counts the winning variants, to tune config.DECODE_VARIANTS.
+
+    Variants still running when another one wins are not interrupted, so
+    they can hold up the next frame's variants by up to one scan. Ones not
+    started yet are skipped once the next frame is submitted. Variants with
+    no result within 'timeout' seconds of the frame (a worker that died
+    never returns one) count as failed.
+    """
+
+    def __init__(self, variants, profile, processes=None, timeout=2.0):
+        unknown = [variant for variant in variants if variant not in PREPROCESSORS]
+        if unknown:
+            raise ValueError("Unknown decode variants: {}".format(", ".join(unknown)))
+
+        self.variants = variants
+        self.timeout = timeout
+        self.frameNumber = multiprocessing.Value("i", 0, lock=False)
+        self.pool = multiprocessing.Pool(processes, initDecodeWorker, (profile, self.frameNumber))
+        self.frames = 0
+        self.unread = 0
+        self.wins = collections.Counter()
+        # Variants whose failure has been logged
+        self.failed = set()
+
+    def logFailure(self, variant, error):
+        if variant not in self.failed:
+            self.failed.add(variant)
+            logger.error("Decode variant %s failed: %r", variant, error)
+
+    def getErrorCallback(self, variant, results):
+        def failed(error):
+            self.logFailure(variant, error)
+            results.put((variant, []))
+        return failed
+
+    def decode(self, gray):
+        """[(data, location)] from the first variant to find symbols, or []"""
+        height, width = gray.shape
+        frame = gray.tobytes()
+
+        self.frames += 1
+        self.frameNumber.value = self.frames
+
+        # Results for this frame only; late ones are left in it and dropped
+        results = queue.Queue()
+        for variant in self.variants:
+            self.pool.apply_async(decodeVariant, (variant, width, height, frame, self.frames),
+                                  callback=results.put,
+                                  error_callback=self.getErrorCallback(variant, results))
+
+        deadline = time.time() + self.timeout
+        waiting = set(self.variants)
+        while waiting:
+            try:
+                variant, symbols = results.get(timeout=max(0, deadline - time.time()))
+            except queue.Empty:
+                for variant in waiting:
+                    self.logFailure(variant, "no result within {}s".format(self.timeout))
+                break
+
+            waiting.discard(variant)
+            if symbols:
+                self.wins[variant] += 1
+                return symbols
+
+        self.unread += 1
+        return []
+
+    def getSummary(self):
+        return {
+            "frames": self.frames,
+            "unread": self.unread,
+            "wins": dict(self.wins),
+        }
+
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
+
+
+class YUVCapture(object):
+    """
+    Raw YUV 4:2:0 frames read straight from the V4L2 device that uv4l
+    creates with --encoding yuv420. read() returns only the luma plane, a
+    height x width numpy view of the buffer the frame was read into, so it
+    is already the Y800 image zbar wants and needs no colour conversion.
+    A fresh buffer per frame keeps frames the decoder still holds intact.
+    """
+
+    def __init__(self, device, width, height):
+        self.width = width
+        self.height = height
+        self.frameSize = width * height * 3 // 2
+        self.file = open(device, "rb", buffering=0)
+
+    def read(self):
+        buffer = bytearray(self.frameSize)
+        if self.file.readinto(buffer) != self.frameSize:
+            return False, None
+        luma = numpy.frombuffer(buffer, numpy.uint8, self.width * self.height)
+        return True, luma.reshape(self.height, self.width)
+
+    def release(self):
+        self.file.close()
+
+
+class ReplayCapture(object):
+    """
+    Frame source replaying a directory of images, in name order, or a video
+    file as grayscale frames at 'fps' (None for as fast as they load), so
+    detectQR can run without a camera. With 'loop' the frames start over
+    instead of running out.
+    """
+
+    IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp", ".pgm", ".pbm", ".tif", ".tiff")
+
+    def __init__(self, path, fps=None, loop=False):
+        self.fps = fps
+        self.loop = loop
+        self.nextTime = None
+
+        if os.path.isdir(path):
+            self.files = sorted(os.path.join(path, name) for name in os.listdir(path)
+                                if name.lower().endswith(self.IMAGE_EXTENSIONS))
+            self.index = 0
+            self.video = None
+        else:
+            self.files = None
+            self.video = cv2.VideoCapture(path)
+
+    def readFrame(self):
+        if self.video is not None:
+            ok, frame = self.video.read()
+            if not ok and self.loop:
+                self.video.set(cv2.CAP_PROP_POS_FRAMES, 0)
+                ok, frame = self.video.read()
+            return cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY) if ok else None
+
+        if self.index == len(self.files):
+            if not (self.loop and self.files):
+                return None
+            self.index = 0
+        self.index += 1
+        return numpy.asarray(Image.open(self.files[self.index - 1]).convert("L"))
+
+    def read(self):
+        frame = self.readFrame()
+        if frame is None:
+            return False, None
+
+        if self.fps:
+            if self.nextTime is None:
+                self.nextTime = time.time()
+            delay = self.nextTime - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            self.nextTime += 1.0 / self.fps
+
+        return True, frame
+
+    def release(self):
+        if self.video is not None:
+            self.video.release()
+
+
+def openCamera():
+    """The frame source config.CAMERA_FORMAT selects"""
+    if CONF.CAMERA_FORMAT == "yuv420":
+        return YUVCapture(CONF.CAMERA_DEVICE, CONF.CAMERA_WIDTH, CONF.CAMERA_HEIGHT)
+    if CONF.CAMERA_FORMAT == "replay":
+        return ReplayCapture(CONF.CAMERA_REPLAY, CONF.CAMERA_REPLAY_FPS)
+    return cv2.VideoCapture(0)
+
+
+class FrameGrabber (threading.Thread):
+    """
+    Reads frames from a cv2.VideoCapture (or anything with the same read())
+    on its own thread and keeps only the newest one, so a slow decoder
+    always gets a fresh frame instead of the driver's backlog. Frames that
+    were replaced before anyone took them are counted as dropped.
+    """
+
+    def __init__(self, camera):
+        super(FrameGrabber, self).__init__()
+        self.daemon = True
+        self.camera = camera
+        self.condition = threading.Condition()
+        self.stopFlag = False
+        # Set when the camera stops returning frames
+        self.finished = False
+
+        self.frame = None
+        self.frameId = 0
+        self.frameTime = 0
+        self.taken = True
+
+        self.captured = 0
+        self.dropped = 0
+
+    def run(self):
+        while not self.stopFlag:
+            ok, frame = self.camera.read()
+            now = time.time()
+
+            with self.condition:
+                if not ok:
+                    self.finished = True
+                    self.condition.notify_all()
+                    return
+
+                if not self.taken:
+                    self.dropped += 1
+                self.frame = frame
+                self.frameId += 1
+                self.frameTime = now
+                self.taken = False
+                self.captured += 1
+                self.condition.notify_all()
+
+    def read(self, lastId=0, timeout=1.0):
+        """
+        (frameId, captureTime, frame) for the newest frame after lastId,
+        or None if there was none within timeout
+        """
+        with self.condition:
+            self.condition.wait_for(
+                lambda: self.frameId > lastId or self.finished, timeout)
+            if self.frameId <= lastId:
+                return None
+            self.taken = True
+            return self.frameId, self.frameTime, self.frame
+
+    def stop(self):
+        self.stopFlag = True
+
+
+class MotionGate(object):
+    """
+    Decides whether a grayscale frame is worth a zbar scan, from a
+    thumbnail taking every 'step'th pixel each way (40x30 for 320x240).
+    A frame is scanned when enough thumbnail pixels changed since the
+    previous frame (a sticker coming into view changes a few percent of
+    them even if the rest of the tray is still), for 'settleFrames'
+    frames after the motion stops, and at least every 'forceEvery' frames.
+    After each frame, motion holds the (left, top, right, bottom) frame
+    pixels that changed, or None if the frame was still.
+    """
+
+    def __init__(self, step=8, pixelThreshold=24, minChanged=0.02, settleFrames=5, forceEvery=15):
+        self.step = step
+        self.pixelThreshold = pixelThreshold
+        self.minChanged = minChanged
+        self.settleFrames = settleFrames
+        self.forceEvery = forceEvery
+
+        self.previous = None
+        self.settle = 0
+        self.sinceScan = 0
+        self.motion = None
+
+    def shouldScan(self, gray):
+        thumb = gray[::self.step, ::self.step].astype(numpy.int16)
+        previous, self.previous = self.previous, thumb
+
+        if previous is None or previous.shape != thumb.shape:
+            changed = True
+            self.motion = (0, 0, gray.shape[1], gray.shape[0])
+        else:
+            changedMask = numpy.abs(thumb - previous) > self.pixelThreshold
+            changed = numpy.count_nonzero(changedMask) >= self.minChanged * thumb.size
+            self.motion = None
+            if changed:
+                ys, xs = numpy.nonzero(changedMask)
+                self.motion = (xs.min() * self.step, ys.min() * self.step,
+                               (xs.max() + 1) * self.step, (ys.max() + 1) * self.step)
+
+        if changed:
+            self.settle = self.settleFrames
+
+        scan = self.settle > 0 or self.sinceScan + 1 >= self.forceEvery
+        if self.settle > 0:
+            self.settle -= 1
+        self.sinceScan = 0 if scan else self.sinceScan + 1
+
+        return scan
+
+
+class RegionTracker(object):
+    """
+    Picks the part of each frame to scan. Until a symbol has been located
+    that is the whole frame. After that it is a window around the last
+    symbols, padded by 'margin' pixels. The whole frame is still scanned,
+    at full resolution so small stickers stay readable, when there was
+    motion outside the window (a sticker shown somewhere else) and every
+    'fullEvery' scans. A scan without a symbol drops the window, so the
+    next one looks at the whole frame again.
+    """
+
+    def __init__(self, margin=40, fullEvery=10):
+        self.margin = margin
+        self.fullEvery = fullEvery
+
+        # (left, top, right, bottom) in frame pixels
+        self.window = None
+        self.scans = 0
+
+    def isInside(self, box):
+        left, top, right, bottom = self.window
+        return box[0] >= left and box[1] >= top and box[2] <= right and box[3] <= bottom
+
+    def getRegion(self, gray, motion=None):
+        """
+        (image, left, top): the part of the frame to scan and where it
+        came from; motion is the changed part of the frame, if known
+        """
+        self.scans += 1
+
+        if self.window is None or self.scans % self.fullEvery == 0 \
+                or (motion is not None and not self.isInside(motion)):
+            return gray, 0, 0
+
+        left, top, right, bottom = self.window
+        return gray[top:bottom, left:right], left, top
+
+    def update(self, locations, left, top, shape):
+        """
+        Record where the region scan found symbols: locations holds each
+        symbol's corner points in region pixels, shape is the frame's
+        """
+        points = [(left + x, top + y) for location in locations for x, y in location]
+
+        if not points:
+            self.window = None
+            return
+
+        height, width = shape[:2]
+        xs = [x for x, _ in points]
+        ys = [y for _, y in points]
+        self.window = (max(0, min(xs) - self.margin), max(0, min(ys) - self.margin),
+                       min(width, max(xs) + self.margin + 1), min(height, max(ys) + self.margin + 1))
+
+
+class ScanStats(object):
+    """Capture and decode rates and detection latency for one scan session"""
+
+    def __init__(self):
+        self.startTime = time.time()
+        self.startCPU = time.process_time()
+        self.endTime = None
+        self.endCPU = None
+        self.captured = 0
+        self.dropped = 0
+        self.decoded = 0
+        self.skipped = 0
+        self.scanSeconds = 0.0
+        self.latencies = []
+        self.variantWins = None
+        # Symbol data -> [first scan, last scan, scans that read it, seconds to first read]
+        self.symbols = {}
+
+    def addDecode(self, seconds=0.0):
+        self.decoded += 1
+        self.scanSeconds += seconds
+
+    def addSkip(self):
+        self.skipped += 1
+
+    def addSymbols(self, datas):
+        """Symbols read by the latest scan, new or not"""
+        for data in datas:
+            if data not in self.symbols:
+                self.symbols[data] = [self.decoded, self.decoded, 0, time.time() - self.startTime]
+            symbol = self.symbols[data]
+            symbol[1] = self.decoded
+            symbol[2] += 1
+
+    def getSymbolSummary(self):
+        """
+        Per symbol: seconds to its first read, and its read rate, the share
+        of scans from its first read to its last that read it
+        """
+        return {data: {"firstSeconds": round(seconds, 3),
+                       "readRate": round(float(hits) / (last - first + 1), 3)}
+                for data, (first, last, hits, seconds) in self.symbols.items()}
+
+    def addDetection(self, captureTime):
+        self.latencies.append(time.time() - captureTime)
+
+    def finish(self, grabber, decoder=None):
+        self.endTime = time.time()
+        self.endCPU = time.process_time()
+        self.captured = grabber.captured
+        self.dropped = grabber.dropped
+        if decoder is not None:
+            self.variantWins = decoder.getSummary()["wins"]
+
+    def getSummary(self):
+        seconds = max((self.endTime or time.time()) - self.startTime, 1e-6)
+        cpuSeconds = (self.endCPU or time.process_time()) - self.startCPU
+        latencies = sorted(self.latencies)
+        return {
+            "seconds": round(seconds, 2),
+            "cpuSeconds": round(cpuSeconds, 2),
+            "captureFps": round(self.captured / seconds, 1),
+            "decodeFps": round(self.decoded / seconds, 1),
+            "dropped": self.dropped,
+            "skipRatio": round(float(self.skipped) / max(self.skipped + self.decoded, 1), 3),
+            "meanScanMs": round(self.scanSeconds / max(self.decoded, 1) * 1e3, 2),
+            "detections": len(latencies),
+            "meanLatencyMs": round(sum(latencies) / len(latencies) * 1e3, 1) if latencies else None,
+            "maxLatencyMs": round(latencies[-1] * 1e3, 1) if latencies else None,
+            "variantWins": self.variantWins,
+        }
+
+    def __str__(self):
+        summary = self.getSummary()
+        return ("{seconds}s ({cpuSeconds}s CPU): capture {captureFps} fps, "
+                "decode {decodeFps} fps ({meanScanMs} ms per scan), {dropped} stale frames dropped, "
+                "{skipRatio:.0%} of frames not scanned, {detections} detections, "
+                "latency mean {meanLatencyMs} ms max {maxLatencyMs} ms"
+                + (", variant wins {variantWins}" if self.variantWins is not None else "")).format(**summary)
+
+
+def detectQR(symbolDetected, stopDetecting=lambda: False, display=False, stats=None, camera=None):
+    """
+    Scan frames from camera (by default the source config.CAMERA_FORMAT
+    selects) until stopDetecting() or the source runs out, calling
+    symbolDetected(data) for each new symbol; returns all symbol data
+    """
+    # Initialize camera and scanners
+    if display:
+        cv2.namedWindow("webcam", flags=cv2.CV_WINDOW_AUTOSIZE)
+    if camera is None:
+        camera = openCamera()
+    scanner = zbar.ImageScanner()
+    configureScanner(scanner, CONF.SCAN_PROFILE)
+
+    # Fork the decode workers before the capture thread starts
+    decoder = None
+    if CONF.PARALLEL_DECODE:
+        decoder = ParallelDecoder(
+            CONF.DECODE_VARIANTS, CONF.SCAN_PROFILE, CONF.DECODE_PROCESSES,
+            CONF.DECODE_TIMEOUT)
+
+    # Capture on a separate thread, decoding only the newest frame
+    if stats is None:
+        stats = ScanStats()
+    grabber = FrameGrabber(camera)
+    grabber.start()
+
+    # Skip zbar on frames where nothing moved
+    gate = None
+    if CONF.MOTION_GATE:
+        gate = MotionGate(forceEvery=CONF.MOTION_FORCE_EVERY)
+    tracker = RegionTracker() if CONF.ROI_TRACKING else None
+
+    # Accumulate data, in order and as a set for the repeat check
+    data = []
+    seen = set()
+    frameId = 0
+    try:
+        while not stopDetecting():
+            frame = grabber.read(frameId)
+            if frame is None:
+                if grabber.finished:
+                    logger.warning("Camera stopped returning frames")
+                    break
+                continue
+            frameId, captureTime, img = frame
+
+            # YUVCapture frames are already grayscale
+            if img.ndim == 3:
+                img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+            if display:
+                cv2.imshow("webcam", img)
+
+            if gate is not None and not gate.shouldScan(img):
+                stats.addSkip()
+                continue
+
+            region, left, top = img, 0, 0
+            if tracker is not None:
+                region, left, top = tracker.getRegion(
+                    img, gate.motion if gate is not None else None)
+
+            scanStart = time.time()
+            if decoder is not None:
+                symbols = decoder.decode(region)
+            else:
+                # Wrap in zbar, whose binding only takes a byte string
+                height, width = region.shape
+                zImg = zbar.Image(width, height, "Y800", region.tobytes())
+                scanner.scan(zImg)
+                symbols = [(symbol.data, symbol.location) for symbol in zImg]
+            stats.addDecode(time.time() - scanStart)
+            stats.addSymbols([symbolData for symbolData, _ in symbols])
+
+            if tracker is not None:
+                tracker.update([location for _, location in symbols],
+                               left, top, img.shape)
+            for symbolData, _ in symbols:
+                if symbolData not in seen:
+                    seen.add(symbolData)
+                    data.append(symbolData)
+                    stats.addDetection(captureTime)
+                    symbolDetected(symbolData)
+    finally:
+        grabber.stop()
+        grabber.join()
+        camera.release()
+        stats.finish(grabber, decoder)
+        if decoder is not None:
+            decoder.close()
+
+    return data
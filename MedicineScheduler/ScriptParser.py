@@ -1,13 +1,79 @@
+import functools
 import json
 from jsonschema import validate, ValidationError, Draft4Validator
 
 
+# Compact sticker payload: "MS1|slot|hour|dosage|name|special|day_of_week",
+# trailing empty fields dropped (see SchedulePrinter/payload.py)
+PAYLOAD_VERSION = "MS1"
+PAYLOAD_SEPARATOR = "|"
+PAYLOAD_FIELDS = ["slot", "hour", "dosage", "name", "special", "day_of_week"]
+
+# Regimen sticker: "MSR|count" then one compact payload per line, every
+# line newline-terminated. Long regimens span several symbols, each
+# holding whole lines
+REGIMEN_VERSION = "MSR"
+RECORD_SEPARATOR = "\n"
+
+
+def parsePayload(data):
+    # Legacy stickers hold the schedule as JSON
+    if not data.startswith(PAYLOAD_VERSION + PAYLOAD_SEPARATOR):
+        return json.loads(data)
+
+    values = data.split(PAYLOAD_SEPARATOR)[1:]
+    if len(values) > len(PAYLOAD_FIELDS):
+        raise ValueError("Too many fields in payload: " + data)
+
+    schedule = {field: value for field, value in zip(PAYLOAD_FIELDS, values)
+                if value != ""}
+    if "slot" in schedule:
+        schedule["slot"] = int(schedule["slot"])
+    return schedule
+
+
+def readSymbol(data):
+    """
+    Parse and validate one scanned symbol record by record, returning
+    (count, regimen, {record: schedule}, errors): the regimen size from
+    the header (None if this symbol has none), whether the symbol is part
+    of a regimen, the valid schedules keyed by their payload text so
+    repeats merge, and messages for invalid records
+    """
+    count = None
+    valid = {}
+    errors = []
+    for record in data.split(RECORD_SEPARATOR):
+        if record == "":
+            continue
+        try:
+            if record.startswith(REGIMEN_VERSION + PAYLOAD_SEPARATOR):
+                count = int(record.split(PAYLOAD_SEPARATOR)[1])
+                continue
+            schedule = parsePayload(record)
+        except ValueError as e:
+            errors.append("Unreadable sticker: {0}".format(e))
+            continue
+
+        err = validateScript(schedule, getSchema())
+        if err is None:
+            valid[record] = schedule
+        else:
+            errors.extend(error.message for error in err)
+    return count, RECORD_SEPARATOR in data, valid, errors
+
+
 def readJSONFile(fileName):
     with open(fileName) as jsonFile:
         data = json.load(jsonFile)
     return data
 
 
+@functools.lru_cache(maxsize=1)
+def getSchema():
+    return readJSONFile("script_schema.json")
+
+
 def validateScripts(instances, schema):
     error = []
     for instance in instances:
@@ -28,8 +94,11 @@ def validateScript(instance, schema):
         return sorted(Draft4Validator(schema).iter_errors(instance), key=lambda x: x.path)
 
 
-def generateSchedule(scheduler, scheduleList, callback):
-    errors = validateScripts(scheduleList, readJSONFile("script_schema.json"))
+def generateSchedule(scheduler, scheduleList, callback, validated=False):
+    # Schedules from readSymbol have been validated already
+    errors = None
+    if not validated:
+        errors = validateScripts(scheduleList, getSchema())
     jobs = None
     if errors is None:
         jobs = [scheduler.add_cron_job(callback,
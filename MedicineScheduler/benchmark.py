@@ -0,0 +1,164 @@
+import argparse
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+import timeit
+import tracemalloc
+
+import Camera
+import config as CONF
+import ScriptParser as parser
+
+# The encoder lives with the sticker printer
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             "..", "SchedulePrinter"))
+import payload
+
+SCHEDULES = [
+    {"name": "Viracept", "slot": 1, "dosage": "1 pill", "hour": "8,12",
+     "special": "After high-fat meal"},
+    {"name": "Indinavir", "slot": 2, "dosage": "2 pills", "hour": "6,14,22"},
+    {"name": "Enfuvirtide", "slot": 0, "dosage": "90mg injection", "hour": "9,21",
+     "day_of_week": "mon-fri"},
+]
+
+
+def benchPayload(number=20000):
+    """Payload size and decode time, legacy JSON against the compact format"""
+    print("{:<12} {:>10} {:>10} {:>12} {:>12}".format(
+        "name", "json B", "compact B", "json us", "compact us"))
+
+    for schedule in SCHEDULES:
+        legacy = json.dumps(schedule)
+        compact = payload.encodeSchedule(schedule)
+        assert parser.parsePayload(compact) == parser.parsePayload(legacy) == schedule
+
+        times = [min(timeit.repeat(lambda: parser.parsePayload(data),
+                                   repeat=3, number=number)) / number
+                 for data in (legacy, compact)]
+
+        print("{:<12} {:>10} {:>10} {:>10.2f}us {:>10.2f}us".format(
+            schedule["name"], len(legacy), len(compact), times[0] * 1e6, times[1] * 1e6))
+
+
+def measureFrames(readFrame, frames):
+    """(CPU seconds, peak bytes allocated) per frame for readFrame()"""
+    tracemalloc.start()
+    peaks = 0
+    cpu = time.process_time()
+    for _ in range(frames):
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        readFrame()
+        peaks += tracemalloc.get_traced_memory()[1] - before
+    cpu = time.process_time() - cpu
+    tracemalloc.stop()
+    return cpu / frames, peaks // frames
+
+
+def benchFramePath(frames=200, width=320, height=240):
+    """
+    Per-frame CPU and allocations from YUV 4:2:0 bytes to a zbar.Image:
+    cv2.VideoCapture's BGR conversion plus detectQR's old cvtColor/PIL
+    round trip, against Camera.YUVCapture's luma plane
+    """
+    frameSize = width * height * 3 // 2
+    with tempfile.NamedTemporaryFile(delete=False) as file:
+        file.write(os.urandom(frameSize) * frames)
+    print("{:<10} {:>12} {:>16}".format("path", "cpu us", "allocated KB"))
+
+    try:
+        import zbar
+
+        def toImage(data):
+            return zbar.Image(width, height, "Y800", data)
+    except ImportError:
+        # Without zbar only the byte string handed to it is timed
+        print("zbar not installed: timing up to the zbar.Image hand-off")
+
+        def toImage(data):
+            return data
+
+    try:
+        import cv2
+        import numpy
+        from PIL import Image
+    except ImportError as e:
+        print("{:<10} skipped: {}".format("opencv", e))
+    else:
+        with open(file.name, "rb") as device:
+            def readOpenCV():
+                yuv = numpy.frombuffer(device.read(frameSize), numpy.uint8)
+                bgr = cv2.cvtColor(yuv.reshape(height * 3 // 2, width), cv2.COLOR_YUV2BGR_I420)
+                gray = cv2.cvtColor(bgr, cv2.COLOR_BGR2GRAY)
+                return toImage(Image.fromarray(gray).tobytes())
+            cpu, allocated = measureFrames(readOpenCV, frames)
+        print("{:<10} {:>12.1f} {:>16.1f}".format("opencv", cpu * 1e6, allocated / 1024))
+
+    capture = Camera.YUVCapture(file.name, width, height)
+    cpu, allocated = measureFrames(lambda: toImage(capture.read()[1].tobytes()), frames)
+    capture.release()
+    print("{:<10} {:>12.1f} {:>16.1f}".format("yuv420", cpu * 1e6, allocated / 1024))
+
+    os.remove(file.name)
+
+
+def benchDetect(path, fps=None):
+    """
+    Replay a directory of images or a video through Camera.detectQR:
+    frame rates, time to first detection and per-sticker read rates
+    """
+    # The replay running out is expected here
+    logging.getLogger(Camera.__name__).setLevel(logging.ERROR)
+
+    stats = Camera.ScanStats()
+    data = Camera.detectQR(lambda data: None, stats=stats,
+                           camera=Camera.ReplayCapture(path, fps))
+
+    summary = stats.getSummary()
+    symbols = stats.getSymbolSummary()
+    print("profile {} gate {} roi {} parallel {}".format(
+        CONF.SCAN_PROFILE, CONF.MOTION_GATE, CONF.ROI_TRACKING, CONF.PARALLEL_DECODE))
+    print(stats)
+    if symbols:
+        print("time to first detection: {:.3f}s".format(
+            min(symbol["firstSeconds"] for symbol in symbols.values())))
+
+    print("{:<40} {:>10} {:>10}".format("sticker", "first s", "read rate"))
+    for symbolData in data:
+        print("{:<40} {:>10.3f} {:>10.1%}".format(
+            symbolData[:40], symbols[symbolData]["firstSeconds"], symbols[symbolData]["readRate"]))
+
+    return summary
+
+
+def main():
+    argParser = argparse.ArgumentParser(description="Benchmark payload parsing and QR scanning")
+    argParser.add_argument("--replay", help="directory of images or video file to scan")
+    argParser.add_argument("--fps", type=float, default=None,
+                           help="replay rate (default: as fast as frames load)")
+    argParser.add_argument("--profile", choices=sorted(Camera.SCAN_PROFILES),
+                           default=CONF.SCAN_PROFILE)
+    argParser.add_argument("--no-gate", action="store_true", help="scan every frame")
+    argParser.add_argument("--no-roi", action="store_true", help="always scan the whole frame")
+    argParser.add_argument("--parallel", action="store_true",
+                           help="decode preprocessing variants in parallel")
+    args = argParser.parse_args()
+
+    if args.replay is None:
+        benchPayload()
+        benchFramePath()
+        return
+
+    CONF.SCAN_PROFILE = args.profile
+    CONF.MOTION_GATE = not args.no_gate
+    CONF.ROI_TRACKING = not args.no_roi
+    CONF.PARALLEL_DECODE = args.parallel
+    benchDetect(args.replay, args.fps)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,35 @@
 EMULATE = True
 LED_TIMEOUT = 10
 BEEPS_TIMEOUT = 3
+
+# Camera frames: "yuv420" reads the luma plane straight from the uv4l
+# device (see uv4l_start.sh), "opencv" goes through cv2.VideoCapture and
+# "replay" plays back CAMERA_REPLAY, a directory of images or a video
+# file, at CAMERA_REPLAY_FPS (recording then works in emulation mode)
+CAMERA_FORMAT = "yuv420"
+CAMERA_REPLAY = "frames"
+CAMERA_REPLAY_FPS = 15
+CAMERA_DEVICE = "/dev/video0"
+CAMERA_WIDTH = 320
+CAMERA_HEIGHT = 240
+
+# Only run zbar on frames that differ from the previous one, and at
+# least every MOTION_FORCE_EVERY frames
+MOTION_GATE = True
+MOTION_FORCE_EVERY = 15
+
+# zbar settings, see Camera.SCAN_PROFILES: "all", "qr" or "qr-fast"
+SCAN_PROFILE = "qr"
+
+# Once a sticker has been found, scan a window around it, and the whole
+# frame only on motion outside the window and periodically
+ROI_TRACKING = True
+
+# Decode each scanned frame in several preprocessing variants at once on
+# a pool of DECODE_PROCESSES worker processes, taking the first that
+# reads (see Camera.PREPROCESSORS); for hard to read stickers. Variants
+# without a result after DECODE_TIMEOUT seconds are given up on
+PARALLEL_DECODE = False
+DECODE_VARIANTS = ["native", "half", "double", "threshold", "sharpen"]
+DECODE_PROCESSES = 3
+DECODE_TIMEOUT = 2.0
@@ -4,9 +4,7 @@ if CONF.EMULATE:
     import FakeHardware as hw
 else:
     import Hardware as hw
-    import cv2
-    import zbar
-    import Image
+import Camera
 import ScriptParser as parser
 from UserInterface import UI, Page
 from apscheduler.schedulers.background import BackgroundScheduler
@@ -43,35 +41,7 @@ def getFiles(d):
             if os.path.isfile(os.path.join(d, file))]
 
 
-def detectQR(symbolDetected, stopDetecting=lambda: False, display=False):
-    # Initialize camera and scanners
-    if display:
-        cv2.namedWindow("webcam", flags=cv2.CV_WINDOW_AUTOSIZE)
-    camera = cv2.VideoCapture(0)
-    scanner = zbar.ImageScanner()
-    scanner.parse_config("enable")
-
-    # Accumulate data
-    data = []
-    while not stopDetecting():
-        _, img = camera.read()  # Read image
-        img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-        pilImg = Image.fromarray(img)  # Convert to PIL image
-        # Wrap in zbar
-        zImg = zbar.Image(
-            pilImg.size[0], pilImg.size[1], "Y800", pilImg.tostring())
-        scanner.scan(zImg)
-        if display:
-            cv2.imshow("webcam", img)
-        for symbol in zImg:
-            if symbol.data not in data:
-                symbolDetected()
-                data.append(symbol.data)
-
-    return data
-
-
-def populateSchedule(sched, data, ui):
+def populateSchedule(sched, data, ui, validated=False):
     def notify(med):
         def onLoad():
             hw.onLED(LEDS[int(med["slot"])])
@@ -89,13 +59,13 @@ def populateSchedule(sched, data, ui):
         logger.debug("notifiying")
 
     logger.debug("populating")
-    parser.generateSchedule(sched, data, notify)
+    parser.generateSchedule(sched, data, notify, validated)
     return sched
 
 
 def record(ui):
-    if CONF.EMULATE:
-        logger.warning("Recording in emulation mode not supported")
+    if CONF.EMULATE and CONF.CAMERA_FORMAT != "replay":
+        logger.warning("Recording in emulation mode needs CAMERA_FORMAT = \"replay\"")
         return
 
     # Stop default listener
@@ -113,14 +83,42 @@ def record(ui):
 
     done = False
 
-    def symbolDetected():
-        symbolDetected.count += 1
-        hw.beep()
-        message = "Recording...\n"
-        message += "{0} schedule(s) recorded!\n".format(symbolDetected.count)
+    # Validated schedules keyed by payload text, each written out as it
+    # arrives, the regimen size once a regimen header has been read, and
+    # the records read from regimen symbols, as opposed to single stickers
+    schedules = {}
+    expected = None
+    regimenRecords = set()
+
+    def symbolDetected(data):
+        nonlocal done, expected
+        count, regimen, records, errors = parser.readSymbol(data)
+        if count is not None:
+            expected = count
+
+        for record, jsonSchedule in records.items():
+            if regimen:
+                regimenRecords.add(record)
+            if record not in schedules:
+                schedules[record] = jsonSchedule
+                path = os.path.join(
+                    SCHED_DIR, "{0}.json".format(jsonSchedule["name"]))
+                with open(path, "w") as file:
+                    json.dump(jsonSchedule, file)
+
+        if errors:
+            message = "Invalid sticker!\n"
+            message += errors[0] + "\n"
+        else:
+            hw.beep()
+            message = "Recording...\n"
+        message += "{0} schedule(s) recorded!\n".format(len(schedules))
         message += "Press Back when done\n"
         ui.printText(message)
-    symbolDetected.count = 0
+
+        # A whole regimen has been read, no need to wait for Back
+        if expected is not None and len(regimenRecords) >= expected:
+            done = True
 
     def stop():
         nonlocal done
@@ -135,21 +133,13 @@ def record(ui):
     bListener = hw.ButtonListener(bBindings)
     bListener.start()
 
-    data = detectQR(symbolDetected, stopDetecting=stopDetecting)
-
-    if len(data) > 0:
-        # Write schedules
-        jsonData = []
-        for jsonString in data:
-            jsonSchedule = json.loads(jsonString)
-            jsonData.append(jsonSchedule)
-            path = os.path.join(
-                SCHED_DIR, "{0}.json".format(jsonSchedule["name"]))
-            with open(path, "w") as file:
-                file.write(jsonString)
-
-        # Start schedule
-        populateSchedule(sched, jsonData, ui)
+    stats = Camera.ScanStats()
+    Camera.detectQR(symbolDetected, stopDetecting=stopDetecting, stats=stats)
+    print("Scan session:", stats)
+
+    if len(schedules) > 0:
+        # Already validated and written, just start the schedule
+        populateSchedule(sched, list(schedules.values()), ui, validated=True)
     else:
         ui.pushPage(lambda x: None, Page("Schedule empty!", [
             Page("Ok")]))
@@ -0,0 +1,242 @@
+#
+#	batch.py
+#
+#	Headless sticker printing for whole regimens
+#
+#	python batch.py schedules.csv more.json -o stickers.pdf [--print] [--regimen]
+#
+#	CSV files have a header row with the script_schema.json field names
+#	(name, slot, dosage, hour, special, day_of_week); JSON files hold one
+#	schedule object or a list of them. Stickers are encoded in parallel,
+#	laid out on label sheets and written as one multi-page PDF.
+#
+#	With --regimen each file is one patient, printed as a single regimen
+#	sticker (see payload.encodeRegimen) instead of one sticker per schedule.
+#
+#	A schedule that cannot be printed (a missing field, a value that cannot
+#	be encoded, a code too big for its label) is reported with its file and
+#	row and left out; the rest of the PDF is still written, but not sent to
+#	the printer, and the exit status is 1.
+#
+
+import argparse
+import csv
+import functools
+import json
+import math
+import multiprocessing
+import subprocess
+import sys
+import time
+
+from PIL import Image, ImageDraw
+
+import payload
+import pyqrcode
+
+FIELDS = ["name", "slot", "dosage", "hour", "special", "day_of_week"]
+# As in script_schema.json
+REQUIRED_FIELDS = ["name", "slot", "dosage", "hour"]
+
+
+def readSchedules(fileName):
+    """[(where, schedule)], where naming the file and row or list index"""
+    if fileName.lower().endswith(".csv"):
+        with open(fileName, "rb") as file:
+            rows = list(csv.DictReader(file))
+        # Row 1 is the header
+        return [("%s row %d" % (fileName, i + 2),
+                 dict((field, row[field].decode("utf-8")) for field in FIELDS if row.get(field)))
+                for i, row in enumerate(rows)]
+
+    with open(fileName) as file:
+        schedules = json.load(file)
+    if isinstance(schedules, dict):
+        return [(fileName, schedules)]
+    return [("%s item %d" % (fileName, i + 1), schedule) for i, schedule in enumerate(schedules)]
+
+
+def checkSchedule(schedule):
+    """Raise ValueError if schedule is not a printable script_schema.json dict"""
+    if not isinstance(schedule, dict):
+        raise ValueError("not a schedule object")
+
+    missing = [field for field in REQUIRED_FIELDS if schedule.get(field, "") == ""]
+    if missing:
+        raise ValueError("missing " + ", ".join(missing))
+
+    if not str(schedule["slot"]).isdigit():
+        raise ValueError("slot must be a whole number, not %r" % schedule["slot"])
+
+
+def renderSticker(cellSize, minBlock, job):
+    """
+    One label cell as (where, error, ("L" image bytes, size)): the code
+    plus a caption, or the reason it could not be made. Runs in the worker
+    processes, so only plain bytes cross back.
+    """
+    where, schedule = job
+    try:
+        checkSchedule(schedule)
+        caption = "%s - %s" % (schedule["name"], schedule["dosage"])
+        qr = pyqrcode.MakeQR(payload.encodeSchedule(schedule),
+                             errorCorrectLevel=pyqrcode.QRErrorCorrectLevel.M)
+        return where, None, renderCell(cellSize, minBlock, [qr], caption)
+    except Exception, e:
+        return where, str(e), None
+
+
+def renderRegimen(cellSize, minBlock, job):
+    """renderSticker for a whole regimen, its symbols side by side"""
+    where, schedules = job
+    try:
+        for i, schedule in enumerate(schedules):
+            try:
+                checkSchedule(schedule)
+            except ValueError, e:
+                raise ValueError("schedule %d: %s" % (i + 1, e))
+
+        caption = ", ".join(schedule["name"] for schedule in schedules)
+        qrs = pyqrcode.MakeQRSequence(payload.encodeRegimen(schedules),
+                                      errorCorrectLevel=pyqrcode.QRErrorCorrectLevel.M)
+        return where, None, renderCell(cellSize, minBlock, qrs, caption)
+    except Exception, e:
+        return where, str(e), None
+
+
+def renderCell(cellSize, minBlock, qrs, caption):
+    """
+    The label cell for renderSticker and renderRegimen; raises ValueError
+    if the code would need modules smaller than minBlock pixels to fit
+    """
+    width, height = cellSize
+    captionHeight = 12
+
+    # Modules across each symbol, quiet zones included
+    sizes = [qr.getModuleCount() + 8 for qr in qrs]
+    block = min(width // sum(sizes), (height - captionHeight) // max(sizes))
+    if block < minBlock:
+        raise ValueError("%d symbol(s), %d modules across, do not fit a %dx%d pixel label "
+                         "at %d pixels per module" % (len(qrs), sum(sizes), width, height, minBlock))
+
+    code = Image.new("L", (sum(sizes) * block, max(sizes) * block), 255)
+    x = 0
+    for qr in qrs:
+        image = qr.make_image(mode="L", block_in_pixels=block)
+        code.paste(image, (x, 0))
+        x += image.size[0]
+
+    cell = Image.new("L", cellSize, 255)
+    cell.paste(code, ((width - code.size[0]) // 2, 0))
+    draw = ImageDraw.Draw(cell)
+    # The default bitmap font only has latin-1
+    if isinstance(caption, unicode):
+        caption = caption.encode("latin-1", "replace")
+    draw.text((0, height - captionHeight), caption, fill=0)
+    del draw
+
+    return cell.tobytes(), cell.size
+
+
+def layoutSheets(cells, pageSize, margin, columns, rows):
+    """Paste label cells row by row onto as many pages as needed"""
+    cellWidth = (pageSize[0] - 2 * margin) // columns
+    cellHeight = (pageSize[1] - 2 * margin) // rows
+
+    pages = []
+    for i, (data, size) in enumerate(cells):
+        if i % (columns * rows) == 0:
+            pages.append(Image.new("L", pageSize, 255))
+
+        position = i % (columns * rows)
+        x = margin + position % columns * cellWidth
+        y = margin + position // columns * cellHeight
+        pages[-1].paste(Image.frombytes("L", size, data), (x, y))
+
+    return pages
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Print schedule stickers in bulk")
+    parser.add_argument("files", nargs="+", help="CSV or JSON schedule files")
+    parser.add_argument("-o", "--output", default="stickers.pdf")
+    parser.add_argument("--print", dest="send", action="store_true",
+                        help="send the PDF to the default printer with lpr")
+    parser.add_argument("--regimen", action="store_true",
+                        help="one regimen sticker per file")
+    parser.add_argument("--processes", type=int, default=None,
+                        help="encoder processes (default: one per CPU)")
+    parser.add_argument("--columns", type=int, default=3)
+    parser.add_argument("--rows", type=int, default=7)
+    parser.add_argument("--dpi", type=int, default=300)
+    parser.add_argument("--page", default="8.27x11.69",
+                        help="page size in inches, WxH (default A4)")
+    parser.add_argument("--margin", type=float, default=0.4, help="in inches")
+    parser.add_argument("--min-module", type=float, default=0.25,
+                        help="smallest printable module in mm (default 0.25)")
+    args = parser.parse_args()
+
+    if args.regimen:
+        render = renderRegimen
+        jobs = [(fileName, [schedule for _, schedule in readSchedules(fileName)])
+                for fileName in args.files]
+    else:
+        render = renderSticker
+        jobs = []
+        for fileName in args.files:
+            jobs.extend(readSchedules(fileName))
+
+    pageSize = tuple(int(float(inches) * args.dpi) for inches in args.page.split("x"))
+    margin = int(args.margin * args.dpi)
+    cellSize = ((pageSize[0] - 2 * margin) // args.columns,
+                (pageSize[1] - 2 * margin) // args.rows)
+    minBlock = max(1, int(math.ceil(args.min_module / 25.4 * args.dpi)))
+
+    start = time.time()
+
+    pool = multiprocessing.Pool(args.processes)
+    try:
+        results = pool.map(functools.partial(render, cellSize, minBlock), jobs,
+                           chunksize=max(1, len(jobs) // (4 * multiprocessing.cpu_count())))
+    finally:
+        pool.close()
+        pool.join()
+
+    encoded = time.time()
+
+    cells = []
+    for where, error, cell in results:
+        if error is None:
+            cells.append(cell)
+        else:
+            print >> sys.stderr, "Skipped %s: %s" % (where, error)
+    skipped = len(results) - len(cells)
+
+    pages = layoutSheets(cells, pageSize, margin, args.columns, args.rows)
+    if not pages:
+        print >> sys.stderr, "No stickers to print"
+        return 1
+
+    pages[0].save(args.output, "PDF", resolution=args.dpi,
+                  save_all=True, append_images=pages[1:])
+
+    done = time.time()
+
+    print >> sys.stderr, "%d stickers on %d pages: encoded at %.1f stickers/sec, %.1f stickers/sec overall" % (
+        len(cells), len(pages), len(cells) / max(encoded - start, 1e-6),
+        len(cells) / max(done - start, 1e-6))
+
+    if skipped:
+        print >> sys.stderr, "%d sticker(s) skipped" % skipped
+        if args.send:
+            print >> sys.stderr, "Not sending %s to the printer" % args.output
+        return 1
+
+    if args.send:
+        subprocess.check_call(["lpr", args.output])
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
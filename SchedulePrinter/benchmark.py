@@ -0,0 +1,320 @@
+#
+#	benchmark.py
+#
+#	Benchmarks for the pyqrcode encoder
+#
+#	python benchmark.py                      stage timings, versions 1-40 x L/M/Q/H
+#	python benchmark.py -o results.json      ... also written as JSON
+#	python benchmark.py --baseline base.json fail on regressions against a
+#	                                         previous results file
+#	python benchmark.py --micro              engine micro-benchmarks
+#
+#	Each case runs in a fresh process, and its memory is how far that
+#	process's peak RSS rose while encoding. benchmark_baseline.json is a
+#	stored run for --baseline; timings only compare on the same hardware,
+#	so regenerate it with -o on the machine that runs the check.
+#
+
+import argparse
+import json
+import multiprocessing
+import platform
+import random
+import resource
+import sys
+import time
+import timeit
+
+import payload
+import pyqrcode
+
+LEVELS = [
+    ("L", pyqrcode.QRErrorCorrectLevel.L),
+    ("M", pyqrcode.QRErrorCorrectLevel.M),
+    ("Q", pyqrcode.QRErrorCorrectLevel.Q),
+    ("H", pyqrcode.QRErrorCorrectLevel.H),
+]
+
+STAGES = ["getBestSegments", "createBuffer", "createBytes",
+          "getBestMaskPattern", "makeImpl", "make_image"]
+
+SCHEDULES = [
+    {"name": "Viracept", "slot": 1, "dosage": "1 pill", "hour": "8,12",
+     "special": "After high-fat meal"},
+    {"name": "Indinavir", "slot": 2, "dosage": "2 pills", "hour": "6,14,22"},
+    {"name": "Enfuvirtide", "slot": 0, "dosage": "90mg injection", "hour": "9,21",
+     "day_of_week": "mon-fri"},
+    {"name": "Ritonavir", "slot": 3, "dosage": "100mg", "hour": "8,20",
+     "special": "With food"},
+]
+
+
+def randomPayload(length, seed=0):
+    rng = random.Random(seed)
+    return "".join(chr(rng.randint(32, 126)) for _ in range(length))
+
+
+def randomCodewords(count, seed=0):
+    rng = random.Random(seed)
+    return [rng.randint(0, 255) for _ in range(count)]
+
+
+def polynomialRemainder(data, ecCount):
+    rsPoly = pyqrcode.QRUtil.getErrorCorrectPolynomial(ecCount)
+    modPoly = pyqrcode.QRPolynomial(data, ecCount).mod(rsPoly)
+    return [modPoly.get(i + modPoly.getLength() - ecCount)
+            if i + modPoly.getLength() - ecCount >= 0 else 0
+            for i in range(ecCount)]
+
+
+def benchReedSolomon(repeat=5, number=200):
+    """Compare the polynomial and table Reed-Solomon engines per RS block"""
+
+    print "%-12s %-6s %12s %12s %8s" % ("data bytes", "ec", "polynomial", "table", "speedup")
+
+    # Block shapes taken from the RS block table (versions 1, 10, 20, 40)
+    for dataCount, ecCount in [(19, 7), (68, 18), (24, 30), (118, 30)]:
+        data = randomCodewords(dataCount)
+
+        assert list(pyqrcode.QRReedSolomon.getRemainder(data, ecCount)) \
+            == polynomialRemainder(data, ecCount)
+
+        polynomial = min(timeit.repeat(
+            lambda: polynomialRemainder(data, ecCount), repeat=repeat, number=number)) / number
+        table = min(timeit.repeat(
+            lambda: pyqrcode.QRReedSolomon.getRemainder(data, ecCount), repeat=repeat, number=number)) / number
+
+        print "%-12d %-6d %10.1fus %10.1fus %7.1fx" % (
+            dataCount, ecCount, polynomial * 1e6, table * 1e6, polynomial / table)
+
+
+def benchMaskScorers(repeat=3, number=1):
+    """Time both mask scorers; test_pyqrcode checks they agree"""
+
+    print "%-8s %-8s %12s %12s %8s" % ("version", "mask", "python", "numpy", "speedup")
+
+    for length in [10, 40, 100, 250, 500]:
+        qr = pyqrcode.MakeQR(randomPayload(length, seed=length),
+                             errorCorrectLevel=pyqrcode.QRErrorCorrectLevel.M)
+
+        timings = {}
+        for scorer in ["python", "numpy"]:
+            pyqrcode.MASK_SCORER = scorer
+            timings[scorer] = min(timeit.repeat(
+                qr.getBestMaskPattern, repeat=repeat, number=number)) / number
+
+        print "%-8d %-8d %10.1fms %10.1fms %7.1fx" % (
+            qr.typeNumber, qr.getBestMaskPattern(), timings["python"] * 1e3, timings["numpy"] * 1e3,
+            timings["python"] / timings["numpy"])
+
+
+def benchRender(repeat=3, number=3):
+    """make_image time by version and block size, square and rounded"""
+
+    print "%-8s %-8s %12s %12s" % ("version", "block", "square", "rounded")
+
+    for typeNumber in [1, 5, 10, 20, 40]:
+        qr = pyqrcode.QRCode(typeNumber, pyqrcode.QRErrorCorrectLevel.M)
+        qr.addData(randomPayload(typeNumber * 10, seed=typeNumber))
+        qr.make()
+
+        for block in [2, 4, 10]:
+            square = min(timeit.repeat(
+                lambda: qr.make_image(block_in_pixels=block), repeat=repeat, number=number)) / number
+            rounded = min(timeit.repeat(
+                lambda: qr.make_image(block_in_pixels=block, rounding=block // 2),
+                repeat=repeat, number=number)) / number
+
+            print "%-8d %-8d %10.1fms %10.1fms" % (typeNumber, block, square * 1e3, rounded * 1e3)
+
+
+def getRegimenPayload(typeNumber, errorCorrectLevel):
+    """
+    The longest run of sticker payloads, one per line, that MakeQR puts
+    in exactly this version
+    """
+    lines = [payload.encodeSchedule(SCHEDULES[i % len(SCHEDULES)]) for i in range(400)]
+    regimen = "\n".join(lines)
+
+    def getTypeNumber(length):
+        try:
+            return pyqrcode.QRUtil.getBestSegments(regimen[:length], errorCorrectLevel)[1]
+        except pyqrcode.CodeLengthOverflowError:
+            return 41
+
+    low, high = 1, len(regimen)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if getTypeNumber(middle) <= typeNumber:
+            low = middle
+        else:
+            high = middle - 1
+
+    return regimen[:low]
+
+
+def timeStage(function, repeat):
+    return min(timeit.repeat(function, repeat=repeat, number=1))
+
+
+def benchStages(data, errorCorrectLevel, repeat):
+    """Seconds per encoder stage for one payload"""
+
+    segments, typeNumber = pyqrcode.QRUtil.getBestSegments(data, errorCorrectLevel)
+    rsBlocks = pyqrcode.QRRSBlock.getRSBlocks(typeNumber, errorCorrectLevel)
+    buffer = pyqrcode.QRCode.createBuffer(typeNumber, rsBlocks, segments)
+
+    qr = pyqrcode.QRCode(typeNumber, errorCorrectLevel)
+    for segment in segments:
+        qr.addSegment(segment)
+    qr.make()
+    maskPattern = qr.getBestMaskPattern()
+
+    times = {
+        "getBestSegments": timeStage(
+            lambda: pyqrcode.QRUtil.getBestSegments(data, errorCorrectLevel), repeat),
+        "createBuffer": timeStage(
+            lambda: pyqrcode.QRCode.createBuffer(typeNumber, rsBlocks, segments), repeat),
+        "createBytes": timeStage(
+            lambda: pyqrcode.QRCode.createBytes(buffer, rsBlocks), repeat),
+        "getBestMaskPattern": timeStage(qr.getBestMaskPattern, repeat),
+        "makeImpl": timeStage(lambda: qr.makeImpl(False, maskPattern), repeat),
+        "make_image": timeStage(lambda: qr.make_image(block_in_pixels=4), repeat),
+    }
+
+    return typeNumber, times
+
+
+def getPeakMemoryKB():
+    # ru_maxrss is in kilobytes on Linux, bytes on OS X
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == "darwin" else peak
+
+
+def runCase(typeNumber, errorCorrectLevel, repeat):
+    """
+    Pool entry point: (payload, actual typeNumber, seconds per stage, KB
+    the process's peak RSS grew by) for one case
+    """
+    start = getPeakMemoryKB()
+    data = getRegimenPayload(typeNumber, errorCorrectLevel)
+    actualTypeNumber, times = benchStages(data, errorCorrectLevel, repeat)
+    return data, actualTypeNumber, times, getPeakMemoryKB() - start
+
+
+def runSuite(typeNumbers, levels, repeat):
+    cases = []
+    # A new process per case, so each peak belongs to that case alone
+    pool = multiprocessing.Pool(1, maxtasksperchild=1)
+
+    print "%-8s %-6s %8s" % ("version", "level", "bytes") + \
+        "".join(" %18s" % stage for stage in STAGES) + " %10s" % "memory KB"
+
+    for typeNumber in typeNumbers:
+        for levelName, errorCorrectLevel in levels:
+            data, actualTypeNumber, times, memory = pool.apply(
+                runCase, (typeNumber, errorCorrectLevel, repeat))
+
+            cases.append({
+                "version": actualTypeNumber,
+                "level": levelName,
+                "payloadBytes": len(data),
+                "seconds": times,
+                "memoryKB": memory,
+            })
+
+            print "%-8d %-6s %8d" % (actualTypeNumber, levelName, len(data)) + \
+                "".join(" %16.2fms" % (times[stage] * 1e3) for stage in STAGES) + " %10d" % memory
+
+    pool.close()
+    pool.join()
+
+    totals = dict((stage, sum(case["seconds"][stage] for case in cases)) for stage in STAGES)
+
+    return {
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "python": platform.python_version(),
+        "numpy": pyqrcode.numpy is not None,
+        "rsEngine": pyqrcode.RS_ENGINE,
+        "maskScorer": pyqrcode.MASK_SCORER,
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "cases": cases,
+        "totals": totals,
+        "peakMemoryKB": max(case["memoryKB"] for case in cases) if cases else 0,
+    }
+
+
+def findRegressions(results, baseline, threshold):
+    """Stages (summed over the cases both runs share) slower by more than threshold"""
+
+    def key(case):
+        return (case["version"], case["level"])
+
+    baseCases = dict((key(case), case) for case in baseline["cases"])
+    shared = [case for case in results["cases"] if key(case) in baseCases]
+
+    regressions = []
+    for stage in STAGES:
+        now = sum(case["seconds"][stage] for case in shared)
+        before = sum(baseCases[key(case)]["seconds"][stage] for case in shared)
+        if before > 0 and now > before * (1 + threshold):
+            regressions.append((stage, before, now))
+
+    return regressions
+
+
+def parseVersions(text):
+    typeNumbers = []
+    for part in text.split(","):
+        first, _, last = part.partition("-")
+        typeNumbers.extend(range(int(first), int(last or first) + 1))
+    return typeNumbers
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the pyqrcode encoder")
+    parser.add_argument("--versions", default="1-40", help="e.g. 1-10,20,40")
+    parser.add_argument("--levels", default="LMQH")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("-o", "--output", help="write the results as JSON")
+    parser.add_argument("--baseline", help="results JSON to compare against")
+    parser.add_argument("--threshold", type=float, default=0.25,
+                        help="allowed slowdown per stage (default 0.25 = 25%%)")
+    parser.add_argument("--micro", action="store_true",
+                        help="run the engine micro-benchmarks instead")
+    args = parser.parse_args()
+
+    if args.micro:
+        benchReedSolomon()
+        benchRender()
+        if pyqrcode.numpy is not None:
+            benchMaskScorers()
+        return 0
+
+    levels = [level for level in LEVELS if level[0] in args.levels.upper()]
+    results = runSuite(parseVersions(args.versions), levels, args.repeat)
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2, sort_keys=True, separators=(",", ": "))
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        if baseline.get("machine") != results["machine"]:
+            print >> sys.stderr, "warning: baseline is from %s, timings may not compare" % \
+                baseline.get("platform", "another machine")
+
+        regressions = findRegressions(results, baseline, args.threshold)
+        for stage, before, now in regressions:
+            print >> sys.stderr, "REGRESSION %s: %.2fms -> %.2fms (+%.0f%%)" % (
+                stage, before * 1e3, now * 1e3, (now / before - 1) * 100)
+        if regressions:
+            return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,12 +1,166 @@
 import sys
 from PyQt4 import QtGui, QtCore
 import pyqrcode
-import json
+import payload
 if sys.platform == "win32":
     import win32print
     import win32ui
 from PIL import Image, ImageWin
+import io
+import Queue
 import subprocess
+import threading
+
+#
+#	Quiet time after the last keystroke before the preview is regenerated
+#
+PREVIEW_DELAY_MS = 250
+
+
+def printPNG(png):
+    """Send a sticker PNG to the default printer; blocks until spooled"""
+
+    if sys.platform == "win32":
+        HORZRES = 8
+        VERTRES = 10
+
+        LOGPIXELSX = 88
+        LOGPIXELSY = 90
+
+        PHYSICALWIDTH = 110
+        PHYSICALHEIGHT = 111
+
+        PHYSICALOFFSETX = 112
+        PHYSICALOFFSETY = 113
+
+        printer_name = win32print.GetDefaultPrinter()
+
+        hDC = win32ui.CreateDC()
+        hDC.CreatePrinterDC(printer_name)
+        printable_area = hDC.GetDeviceCaps(
+            HORZRES), hDC.GetDeviceCaps(VERTRES)
+        printer_size = hDC.GetDeviceCaps(
+            PHYSICALWIDTH), hDC.GetDeviceCaps(PHYSICALHEIGHT)
+        printer_margins = hDC.GetDeviceCaps(
+            PHYSICALOFFSETX), hDC.GetDeviceCaps(PHYSICALOFFSETY)
+
+        bmp = Image.open(io.BytesIO(png))
+        if bmp.size[0] > bmp.size[1]:
+            bmp = bmp.rotate(90)
+
+        ratios = [1.0 * printable_area[0] / bmp.size[0],
+                  1.0 * printable_area[1] / bmp.size[1]]
+        scale = min(ratios)
+
+        hDC.StartDoc("Schedule")
+        hDC.startPage()
+
+        dib = ImageWin.Dib(bmp)
+        scaled_width, scaled_height = [int(scale * i) for i in bmp.size]
+        x1 = int((printer_size[0] - scaled_width) / 2)
+        y1 = int((printer_size[1] - scaled_height) / 2)
+        x2 = x1 + scaled_width
+        y2 = y1 + scaled_height
+        dib.draw(hDC.GetHandleOutput(), (x1, y1, x2, y2))
+
+        hDC.EndPage()
+        hDC.EndDoc()
+        hDC.DeleteDC()
+
+    elif sys.platform == "linux2":
+        lpr = subprocess.Popen(["lpr"], stdin=subprocess.PIPE)
+        lpr.communicate(png)
+        if lpr.returncode != 0:
+            raise IOError("lpr exited with %d" % lpr.returncode)
+
+
+def renderPNG(data, regimen=False):
+    """Sticker PNG for an encoded schedule, or a regimen's symbols side by side"""
+
+    if not regimen:
+        return pyqrcode.QR_CACHE.getRender(
+            "make_png", data, errorCorrectLevel=pyqrcode.QRErrorCorrectLevel.M)
+
+    out = io.BytesIO()
+    pyqrcode.MakeQRSequenceImage(
+        data, mode="1", errorCorrectLevel=pyqrcode.QRErrorCorrectLevel.M).save(out, "PNG")
+    return out.getvalue()
+
+
+class StickerWorker(QtCore.QObject):
+    """
+    Encodes previews and spools print jobs on two background threads, so
+    the GUI thread only ever swaps pixmaps. Previews are coalesced: only
+    the newest request is rendered and results for superseded requests are
+    dropped. Print jobs run in order, reporting progress via printStatus.
+    Signals are emitted from the worker threads and delivered queued to
+    the GUI thread.
+    """
+
+    previewReady = QtCore.pyqtSignal(int, object)
+    previewFailed = QtCore.pyqtSignal(int, str)
+    printStatus = QtCore.pyqtSignal(int, str)
+
+    def __init__(self):
+        super(StickerWorker, self).__init__()
+
+        # Newest preview request as (generation, data, regimen), and the
+        # generation it must still match when done
+        self.pending = None
+        self.generation = 0
+        self.condition = threading.Condition()
+
+        self.printJobs = Queue.Queue()
+
+        for target in [self.runPreviews, self.runPrints]:
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+
+    def requestPreview(self, generation, data, regimen=False):
+        with self.condition:
+            self.generation = generation
+            self.pending = (generation, data, regimen)
+            self.condition.notify()
+
+    def cancelPreview(self, generation):
+        """Drop queued work and any result still to come for older generations"""
+        with self.condition:
+            self.generation = generation
+            self.pending = None
+
+    def submitPrint(self, jobId, png):
+        self.printJobs.put((jobId, png))
+
+    def runPreviews(self):
+        while True:
+            with self.condition:
+                while self.pending is None:
+                    self.condition.wait()
+                generation, data, regimen = self.pending
+                self.pending = None
+
+            try:
+                png = renderPNG(data, regimen)
+            except Exception, e:
+                self.previewFailed.emit(generation, str(e))
+                continue
+
+            with self.condition:
+                stale = generation != self.generation
+            if not stale:
+                self.previewReady.emit(generation, png)
+
+    def runPrints(self):
+        while True:
+            jobId, png = self.printJobs.get()
+            self.printStatus.emit(jobId, "printing")
+            try:
+                printPNG(png)
+            except Exception, e:
+                self.printStatus.emit(jobId, "failed: %s" % e)
+            else:
+                self.printStatus.emit(jobId, "sent to printer")
 
 
 class Window(QtGui.QWidget):
@@ -14,6 +168,26 @@ class Window(QtGui.QWidget):
     def __init__(self, x, y, w, h, title):
         super(Window, self).__init__()
 
+        # PNG of the sticker being previewed, and what Print sends
+        self.png = None
+
+        # Schedules on the regimen sticker being built
+        self.regimen = []
+
+        # Bumped for every preview request; older results are dropped
+        self.generation = 0
+        self.printJobs = 0
+
+        self.worker = StickerWorker()
+        self.worker.previewReady.connect(self.onPreviewReady)
+        self.worker.previewFailed.connect(self.onPreviewFailed)
+        self.worker.printStatus.connect(self.onPrintStatus)
+
+        self.previewTimer = QtCore.QTimer(self)
+        self.previewTimer.setSingleShot(True)
+        self.previewTimer.setInterval(PREVIEW_DELAY_MS)
+        self.previewTimer.timeout.connect(self.generateQR)
+
         self.initUI()
         self.setGeometry(x, y, w, h)
         self.setWindowTitle(title)
@@ -36,6 +210,7 @@ class Window(QtGui.QWidget):
         lDays = QtGui.QLabel("Days")
         lSpecial = QtGui.QLabel("Special")
         self.image = QtGui.QLabel()
+        self.status = QtGui.QLabel()
 
         self.eName = QtGui.QLineEdit()
         self.eDosage = QtGui.QLineEdit()
@@ -45,8 +220,10 @@ class Window(QtGui.QWidget):
         self.eDays = QtGui.QLineEdit()
         self.eSpecial = QtGui.QLineEdit()
 
-        bGenerate = QtGui.QPushButton("Generate")
+        self.bGenerate = QtGui.QPushButton("Generate")
         bPrint = QtGui.QPushButton("Print")
+        bAddRegimen = QtGui.QPushButton("Add to regimen")
+        bClearRegimen = QtGui.QPushButton("New regimen")
 
         grid.addWidget(lName, 1, 0)
         grid.addWidget(self.eName, 1, 1, 1, 3)
@@ -60,84 +237,122 @@ class Window(QtGui.QWidget):
         grid.addWidget(self.eDays, 5, 1, 1, 3)
         grid.addWidget(lSpecial, 6, 0)
         grid.addWidget(self.eSpecial, 6, 1, 1, 3)
-        grid.addWidget(bGenerate, 7, 2, 1, 2)
+        grid.addWidget(self.bGenerate, 7, 2, 1, 2)
         grid.addWidget(bPrint, 7, 4, 1, 2)
+        grid.addWidget(bAddRegimen, 8, 2, 1, 2)
+        grid.addWidget(bClearRegimen, 8, 4, 1, 2)
         grid.addWidget(self.image, 1, 4, 6, 6)
+        grid.addWidget(self.status, 9, 0, 1, 10)
 
         self.setLayout(grid)
 
-        bGenerate.clicked.connect(self.generateQR)
+        self.bGenerate.clicked.connect(self.generateQR)
         bPrint.clicked.connect(self.printQR)
+        bAddRegimen.clicked.connect(self.addToRegimen)
+        bClearRegimen.clicked.connect(self.clearRegimen)
 
-    def setImage(self, fileName):
-        pic = QtGui.QPixmap(fileName)
+        # Live preview
+        for edit in [self.eName, self.eDosage, self.eHours, self.eDays, self.eSpecial]:
+            edit.textChanged.connect(self.schedulePreview)
+        self.eSlot.currentIndexChanged.connect(self.schedulePreview)
+
+    def setImage(self, png):
+        pic = QtGui.QPixmap()
+        pic.loadFromData(png, "PNG")
         pic = pic.scaled(self.image.size(), QtCore.Qt.KeepAspectRatio)
         self.image.setPixmap(pic)
 
-    def generateQR(self):
+    def getSchedule(self):
         data = {
-            "name": str(self.eName.text()),
+            "name": unicode(self.eName.text()),
             "slot": int(self.eSlot.currentText()),
-            "dosage": str(self.eDosage.text()),
-            "hour": str(self.eHours.text())
+            "dosage": unicode(self.eDosage.text()),
+            "hour": unicode(self.eHours.text())
         }
         if self.eSpecial.text() != "":
-            data["special"] = str(self.eSpecial.text())
-        qrImage = pyqrcode.MakeQRImage(json.dumps(data), errorCorrectLevel=pyqrcode.QRErrorCorrectLevel.M)
-        qrImage.save("tmp.jpg")
-        self.setImage("tmp.jpg")
+            data["special"] = unicode(self.eSpecial.text())
+        return data
+
+    def setStatus(self, text):
+        self.status.setText(text)
+
+    def schedulePreview(self):
+        """Restart the debounce timer; whatever is in flight is now stale"""
+        # Keep showing the regimen sticker while one is being built
+        if self.regimen:
+            return
+        self.generation += 1
+        self.worker.cancelPreview(self.generation)
+        self.previewTimer.start()
+
+    def requestPreview(self, data, regimen=False):
+        self.previewTimer.stop()
+        self.generation += 1
+        self.worker.requestPreview(self.generation, data, regimen)
+
+    def generateQR(self):
+        # The regimen sticker stays until New regimen
+        if self.regimen:
+            return
+        try:
+            data = payload.encodeSchedule(self.getSchedule())
+        except ValueError, e:
+            self.setStatus(str(e))
+            return
+        self.requestPreview(data)
+
+    def addToRegimen(self):
+        """Add the form's schedule and preview the whole regimen as one sticker"""
+        schedule = self.getSchedule()
+        try:
+            data = payload.encodeRegimen(self.regimen + [schedule])
+        except ValueError, e:
+            self.setStatus(str(e))
+            return
+
+        self.regimen.append(schedule)
+        self.requestPreview(data, regimen=True)
+        self.setWindowTitle("Schedule Printer - regimen of %d" % len(self.regimen))
+
+        # A single sticker would replace the regimen's until New regimen
+        self.bGenerate.setEnabled(False)
+        self.bGenerate.setToolTip("Start a new regimen to print single stickers")
+
+    def clearRegimen(self):
+        self.regimen = []
+        self.setWindowTitle("Schedule Printer")
+        self.bGenerate.setEnabled(True)
+        self.bGenerate.setToolTip("")
+
+        # Drop the regimen sticker and anything still rendering it
+        self.previewTimer.stop()
+        self.generation += 1
+        self.worker.cancelPreview(self.generation)
+        self.png = None
+        self.image.clear()
+        self.setStatus("")
+
+    def onPreviewReady(self, generation, png):
+        if generation != self.generation:
+            return
+        self.png = png
+        self.setImage(png)
+        self.setStatus("")
+
+    def onPreviewFailed(self, generation, error):
+        if generation == self.generation:
+            self.setStatus("Cannot encode: %s" % error)
+
+    def onPrintStatus(self, jobId, status):
+        self.setStatus("Print job %d %s" % (jobId, status))
 
     def printQR(self):
-        if sys.platform == "win32":
-            HORZRES = 8
-            VERTRES = 10
-
-            LOGPIXELSX = 88
-            LOGPIXELSY = 90
-
-            PHYSICALWIDTH = 110
-            PHYSICALHEIGHT = 111
-
-            PHYSICALOFFSETX = 112
-            PHYSICALOFFSETY = 113
-
-            printer_name = win32print.GetDefaultPrinter()
-            file_name = "tmp.jpg"
-
-            hDC = win32ui.CreateDC()
-            hDC.CreatePrinterDC(printer_name)
-            printable_area = hDC.GetDeviceCaps(
-                HORZRES), hDC.GetDeviceCaps(VERTRES)
-            printer_size = hDC.GetDeviceCaps(
-                PHYSICALWIDTH), hDC.GetDeviceCaps(PHYSICALHEIGHT)
-            printer_margins = hDC.GetDeviceCaps(
-                PHYSICALOFFSETX), hDC.GetDeviceCaps(PHYSICALOFFSETY)
-
-            bmp = Image.open(file_name)
-            if bmp.size[0] > bmp.size[1]:
-                bmp = bmp.rotate(90)
-
-            ratios = [1.0 * printable_area[0] / bmp.size[0],
-                      1.0 * printable_area[1] / bmp.size[1]]
-            scale = min(ratios)
-
-            hDC.StartDoc(file_name)
-            hDC.startPage()
-
-            dib = ImageWin.Dib(bmp)
-            scaled_width, scaled_height = [int(scale * i) for i in bmp.size]
-            x1 = int((printer_size[0] - scaled_width) / 2)
-            y1 = int((printer_size[1] - scaled_height) / 2)
-            x2 = x1 + scaled_width
-            y2 = y1 + scaled_height
-            dib.draw(hDC.GetHandleOutput(), (x1, y1, x2, y2))
-
-            hDC.EndPage()
-            hDC.EndDoc()
-            hDC.DeleteDC()
-
-        elif sys.platform == "linux2":
-            subprocess.Popen(["lpr", "tmp.jpg"])
+        if self.png is None:
+            return
+
+        self.printJobs += 1
+        self.setStatus("Print job %d queued" % self.printJobs)
+        self.worker.submitPrint(self.printJobs, self.png)
 
 
 def main():
@@ -0,0 +1,60 @@
+#
+#	payload.py
+#
+#	Compact sticker payload, decoded by ScriptParser.parsePayload on the Pi
+#
+#	"MS1|slot|hour|dosage|name|special|day_of_week"
+#
+#	Fields are positional and trailing empty fields are dropped, so a
+#	sticker is the JSON payload minus the keys, quotes and braces
+#
+#	"MSR|count\nMS1|...\nMS1|...\n"
+#
+#	A regimen sticker holds a patient's whole schedule list, one record
+#	per line after a header with the record count, so the Pi knows when
+#	it has read them all. Every line ends in a newline, so each symbol of
+#	a regimen split across several holds one and is told apart from a
+#	single schedule sticker
+#
+
+VERSION = "MS1"
+SEPARATOR = "|"
+REGIMEN_VERSION = "MSR"
+RECORD_SEPARATOR = "\n"
+FIELDS = ["slot", "hour", "dosage", "name", "special", "day_of_week"]
+
+
+def toText(value):
+    # JSON gives unicode, which goes on the sticker as UTF-8
+    if isinstance(value, unicode):
+        return value.encode("utf-8")
+    return str(value)
+
+
+def encodeSchedule(schedule):
+    """schedule is a dict as in script_schema.json"""
+
+    values = [toText(schedule.get(field, "")) for field in FIELDS]
+    for value in values:
+        for separator in [SEPARATOR, RECORD_SEPARATOR]:
+            if separator in value:
+                raise ValueError("'%s' may not contain %r" % (value, separator))
+
+    while values and values[-1] == "":
+        values.pop()
+
+    return SEPARATOR.join([VERSION] + values)
+
+
+def encodeRegimen(schedules):
+    """schedules is a list of script_schema.json dicts, duplicates dropped"""
+
+    records = []
+    for schedule in schedules:
+        record = encodeSchedule(schedule)
+        if record not in records:
+            records.append(record)
+
+    header = SEPARATOR.join([REGIMEN_VERSION, str(len(records))])
+
+    return "".join(record + RECORD_SEPARATOR for record in [header] + records)
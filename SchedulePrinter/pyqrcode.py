@@ -12,9 +12,17 @@
 #
 #
 
-import math
+import binascii
+import io
 import sys
-from PIL import Image, ImageDraw
+import threading
+from collections import OrderedDict
+from PIL import Image, ImageDraw, ImageOps
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 # QRCode for Python
 #
@@ -35,11 +43,25 @@ from PIL import Image, ImageDraw
 #   http://www.denso-wave.com/qrcode/faqpatent-e.html
 
 
+#
+#	Reed-Solomon engine used by QRCode.createBytes: "table" for the
+#	iterative QRReedSolomon, "polynomial" for the original QRPolynomial.mod
+#
+RS_ENGINE = "table"
+
+#
+#	Mask penalty scorer used by QRCode.getBestMaskPattern: "numpy" scores
+#	all eight masks in one vectorized pass, "python" uses QRUtil.getLostPoint
+#
+MASK_SCORER = "python" if numpy is None else "numpy"
+
+
 class QRMode:
     MODE_NUMBER = 1 << 0
     MODE_ALPHA_NUM = 1 << 1
     MODE_8BIT_BYTE = 1 << 2
     MODE_KANJI = 1 << 3
+    MODE_STRUCTURED_APPEND = 3
 
 
 class QRErrorCorrectLevel:
@@ -68,40 +90,107 @@ class QR8bitByte:
     def getLength(self):
         return len(self.data)
 
+    def getLengthInBits(self):
+        return len(self.data) * 8
+
     def write(self, buffer):
-        for i in range(len(self.data)):
-            #// not JIS ...
-            buffer.put(ord(self.data[i]), 8)
+        #// not JIS ...
+        buffer.putBytes(bytearray(ord(c) & 0xff for c in self.data))
 
     def __repr__(self):
         return self.data
 
 
-def MakeQR(data, minTypeNumber=0, errorCorrectLevel=QRErrorCorrectLevel.Q, verbose=False):
-    """This tries to produce a reasonable QR Code"""
+class QRNumber:
+    """Digits only, three per 10 bits"""
 
-    #
-    #	Try and guess the level ... this is only written for Q
-    #	so probably overestimates
-    #
-    if minTypeNumber == 0:
-        bits_needed = (len(data) + 1) * 8
-        minTypeNumber = (bits_needed + 50) / 100
+    def __init__(self, data):
+        self.mode = QRMode.MODE_NUMBER
+        self.data = data
+
+    def getLength(self):
+        return len(self.data)
+
+    def getLengthInBits(self):
+        return len(self.data) // 3 * 10 + [0, 4, 7][len(self.data) % 3]
+
+    def write(self, buffer):
+        for i in range(0, len(self.data), 3):
+            digits = self.data[i:i + 3]
+            buffer.put(int(digits), [0, 4, 7, 10][len(digits)])
+
+    def __repr__(self):
+        return self.data
+
+
+class QRAlphaNum:
+    """Digits, upper case letters and ' $%*+-./:', two per 11 bits"""
+
+    CHARS = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ $%*+-./:"
+    CODES = dict((c, i) for i, c in enumerate(CHARS))
+
+    def __init__(self, data):
+        self.mode = QRMode.MODE_ALPHA_NUM
+        self.data = data
+
+    def getLength(self):
+        return len(self.data)
+
+    def getLengthInBits(self):
+        return len(self.data) // 2 * 11 + len(self.data) % 2 * 6
+
+    def write(self, buffer):
+        for i in range(0, len(self.data) - 1, 2):
+            buffer.put(QRAlphaNum.CODES[self.data[i]] * 45
+                       + QRAlphaNum.CODES[self.data[i + 1]], 11)
+
+        if len(self.data) % 2 == 1:
+            buffer.put(QRAlphaNum.CODES[self.data[-1]], 6)
+
+    def __repr__(self):
+        return self.data
+
+
+class QRStructuredAppend:
+    """
+    Header linking up to 16 symbols into one message: symbol index and
+    count in 4 bits each, where the length field would go, then the
+    parity (XOR) of every byte of the whole message
+    """
 
-        minTypeNumber = int(minTypeNumber)
+    def __init__(self, index, total, parity):
+        self.mode = QRMode.MODE_STRUCTURED_APPEND
+        self.index = index
+        self.total = total
+        self.parity = parity
 
-    for x in xrange(0, 50):
-        try:
-            qr = QRCode(minTypeNumber + x, errorCorrectLevel)
-            qr.addData(data)
-            qr.make()
+    def getLength(self):
+        return self.index << 4 | (self.total - 1)
+
+    def getLengthInBits(self):
+        return 8
+
+    def write(self, buffer):
+        buffer.put(self.parity, 8)
 
-            return qr
-        except CodeLengthOverflowError, x:
-            if verbose:
-                print >> sys.stderr, "QRCode.Make - bad guess - trying again", x
+    def __repr__(self):
+        return "SA(%d/%d)" % (self.index + 1, self.total)
+
+
+def MakeQR(data, minTypeNumber=0, errorCorrectLevel=QRErrorCorrectLevel.Q, verbose=False):
+    """This produces the smallest QR Code (of at least minTypeNumber) that fits"""
 
-            continue
+    segments, typeNumber = QRUtil.getBestSegments(data, errorCorrectLevel, minTypeNumber)
+
+    if verbose:
+        print >> sys.stderr, "QRCode.Make - using typeNumber", typeNumber, segments
+
+    qr = QRCode(typeNumber, errorCorrectLevel)
+    for segment in segments:
+        qr.addSegment(segment)
+    qr.make()
+
+    return qr
 
 
 def MakeQRImage(data, minTypeNumber=0, errorCorrectLevel=QRErrorCorrectLevel.Q, **ad):
@@ -113,25 +202,207 @@ def MakeQRImage(data, minTypeNumber=0, errorCorrectLevel=QRErrorCorrectLevel.Q,
     return qr_image
 
 
+def MakeQRSequence(data, maxTypeNumber=10, errorCorrectLevel=QRErrorCorrectLevel.Q, separator="\n"):
+    """
+    One symbol if data fits in maxTypeNumber, otherwise up to 16 symbols
+    joined by structured append. data is only split after a separator, so
+    every symbol holds whole records and can be read on its own; a record
+    too long for maxTypeNumber gets a larger symbol to itself.
+    """
+
+    try:
+        segments, typeNumber = QRUtil.getBestSegments(data, errorCorrectLevel)
+    except CodeLengthOverflowError:
+        # Too long for any single symbol, split it below
+        typeNumber = None
+    if typeNumber is not None and typeNumber <= maxTypeNumber:
+        qr = QRCode(typeNumber, errorCorrectLevel)
+        for segment in segments:
+            qr.addSegment(segment)
+        qr.make()
+        return [qr]
+
+    records = [record + separator for record in data.split(separator)]
+    records[-1] = records[-1][:-len(separator)]
+    if records[-1] == "":
+        records.pop()
+
+    #
+    #	Pack records greedily, with a placeholder header to count its 20 bits
+    #
+    header = QRStructuredAppend(0, 16, 0)
+    chunks = []
+    for record in records:
+        if chunks:
+            segments = QRUtil.getBestSegments(chunks[-1] + record, errorCorrectLevel)[0]
+            try:
+                if QRUtil.getTypeNumber([header] + segments, errorCorrectLevel) <= maxTypeNumber:
+                    chunks[-1] += record
+                    continue
+            except CodeLengthOverflowError:
+                pass
+        chunks.append(record)
+
+    if len(chunks) > 16:
+        raise ValueError("%d symbols needed, structured append allows 16" % len(chunks))
+
+    parity = 0
+    for c in data:
+        parity ^= ord(c) & 0xff
+
+    qrs = []
+    for index, chunk in enumerate(chunks):
+        segments = [QRStructuredAppend(index, len(chunks), parity)] + \
+            QRUtil.getBestSegments(chunk, errorCorrectLevel)[0]
+
+        qr = QRCode(QRUtil.getTypeNumber(segments, errorCorrectLevel), errorCorrectLevel)
+        for segment in segments:
+            qr.addSegment(segment)
+        qr.make()
+        qrs.append(qr)
+
+    return qrs
+
+
+def MakeQRSequenceImage(data, maxTypeNumber=10, errorCorrectLevel=QRErrorCorrectLevel.Q, **ad):
+    """MakeQRSequence as one image, the symbols side by side"""
+
+    images = [qr.make_image(**ad) for qr in MakeQRSequence(data, maxTypeNumber, errorCorrectLevel)]
+
+    im = Image.new(images[0].mode,
+                   (sum(image.size[0] for image in images), max(image.size[1] for image in images)),
+                   ad.get("bg", "white"))
+    x = 0
+    for image in images:
+        im.paste(image, (x, 0))
+        x += image.size[0]
+
+    return im
+
+
+class QRCodeCache(object):
+    """
+    Bounded LRU cache of finished symbols, keyed by payload, minTypeNumber
+    and errorCorrectLevel, plus up to 'maxRenders' rendered outputs per
+    symbol keyed by render method and settings.
+
+    Cached QRCodes are shared, so treat them as read-only; images are
+    copied on the way out.
+    """
+
+    def __init__(self, maxSize=256, maxRenders=4):
+        self.maxSize = maxSize
+        self.maxRenders = maxRenders
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.renderHits = 0
+        self.renderMisses = 0
+
+    def getEntry(self, data, minTypeNumber, errorCorrectLevel):
+        key = (data, minTypeNumber, errorCorrectLevel)
+
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self.hits += 1
+                self.entries[key] = entry
+                return entry
+            self.misses += 1
+
+        entry = (MakeQR(data, minTypeNumber, errorCorrectLevel), OrderedDict())
+
+        with self.lock:
+            self.entries[key] = entry
+            while len(self.entries) > self.maxSize:
+                self.entries.popitem(last=False)
+
+        return entry
+
+    def getCode(self, data, minTypeNumber=0, errorCorrectLevel=QRErrorCorrectLevel.Q):
+        """MakeQR, from the cache when possible"""
+        return self.getEntry(data, minTypeNumber, errorCorrectLevel)[0]
+
+    def getRender(self, method, data, minTypeNumber=0, errorCorrectLevel=QRErrorCorrectLevel.Q, **ad):
+        """
+        MakeQR(...).<method>(**ad) for one of make_image, make_png,
+        make_bitmap, make_pbm or make_svg, from the cache when possible
+        """
+        qr, renders = self.getEntry(data, minTypeNumber, errorCorrectLevel)
+        key = (method, tuple(sorted(ad.items())))
+
+        with self.lock:
+            render = renders.pop(key, None)
+            if render is not None:
+                self.renderHits += 1
+            else:
+                self.renderMisses += 1
+
+        if render is None:
+            render = getattr(qr, method)(**ad)
+
+        with self.lock:
+            renders[key] = render
+            while len(renders) > self.maxRenders:
+                renders.popitem(last=False)
+
+        if isinstance(render, Image.Image):
+            return render.copy()
+        return render
+
+    def getStats(self):
+        with self.lock:
+            return {
+                "size": len(self.entries),
+                "maxSize": self.maxSize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "renderHits": self.renderHits,
+                "renderMisses": self.renderMisses,
+            }
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+#
+#	Shared cache for callers that re-encode the same payloads
+#
+QR_CACHE = QRCodeCache()
+
+
 class QRCode(object):
 
     def __init__(self, typeNumber, errorCorrectLevel):
         self.typeNumber = typeNumber
         self.errorCorrectLevel = errorCorrectLevel
         self.modules = None
+        self.reserved = None
         self.moduleCount = 0
         self.dataCache = None
         self.dataList = []
 
     def addData(self, data):
         newData = QR8bitByte(data)
-        self.dataList.append(newData)
+        self.addSegment(newData)
+
+    def addSegment(self, segment):
+        """Add a QR8bitByte, QRNumber, QRAlphaNum or QRStructuredAppend"""
+        self.dataList.append(segment)
         self.dataCache = None
 
     def isDark(self, row, col):
         if row < 0 or self.moduleCount <= row or col < 0 or self.moduleCount <= col:
             return False
-        return self.modules[row][col]
+        return self.modules[row * self.moduleCount + col] == 1
+
+    def setModule(self, row, col, dark):
+        """Set a function module, reserving it from data placement"""
+        index = row * self.moduleCount + col
+        self.modules[index] = 1 if dark else 0
+        self.reserved[index] = 1
 
     def getModuleCount(self):
         return self.moduleCount
@@ -140,27 +411,56 @@ class QRCode(object):
         self.makeImpl(False, self.getBestMaskPattern())
 
     def makeImpl(self, test, maskPattern):
+        #
+        #	Row-major, one byte per module (1 = dark); 'reserved' marks
+        #	function modules that data placement must skip
+        #
+        modules, reserved = QRCode.getFunctionPatterns(self.typeNumber, test)
         self.moduleCount = self.typeNumber * 4 + 17
-        self.modules = [None] * self.moduleCount
+        self.modules = bytearray(modules)
+        self.reserved = bytearray(reserved)
 
-        for row in range(self.moduleCount):
-            self.modules[row] = [None] * self.moduleCount
-
-        self.setupPositionProbePattern(0, 0)
-        self.setupPositionProbePattern(self.moduleCount - 7, 0)
-        self.setupPositionProbePattern(0, self.moduleCount - 7)
-        self.setupPositionAdjustPattern()
-        self.setupTimingPattern()
         self.setupTypeInfo(test, maskPattern)
 
-        if self.typeNumber >= 7:
-            self.setupTypeNumber(test)
-
         if self.dataCache is None:
             self.dataCache = QRCode.createData(
                 self.typeNumber, self.errorCorrectLevel, self.dataList)
         self.mapData(self.dataCache, maskPattern)
 
+    #
+    #	Everything but the format info depends only on the version, so
+    #	each (typeNumber, test) template is built once and copied
+    #
+    FUNCTION_PATTERNS = {}
+
+    @staticmethod
+    def getFunctionPatterns(typeNumber, test):
+        """(modules, reserved) with every function pattern for a version"""
+        template = QRCode.FUNCTION_PATTERNS.get((typeNumber, test))
+        if template is not None:
+            return template
+
+        qr = QRCode(typeNumber, QRErrorCorrectLevel.M)
+        qr.moduleCount = typeNumber * 4 + 17
+        qr.modules = bytearray(qr.moduleCount * qr.moduleCount)
+        qr.reserved = bytearray(qr.moduleCount * qr.moduleCount)
+
+        qr.setupPositionProbePattern(0, 0)
+        qr.setupPositionProbePattern(qr.moduleCount - 7, 0)
+        qr.setupPositionProbePattern(0, qr.moduleCount - 7)
+        qr.setupPositionAdjustPattern()
+        qr.setupTimingPattern()
+
+        # Reserve the format info area; makeImpl fills it in per mask
+        qr.setupTypeInfo(True, 0)
+
+        if typeNumber >= 7:
+            qr.setupTypeNumber(test)
+
+        template = (qr.modules, qr.reserved)
+        QRCode.FUNCTION_PATTERNS[(typeNumber, test)] = template
+        return template
+
     def setupPositionProbePattern(self, row, col):
 
         for r in range(-1, 8):
@@ -171,15 +471,23 @@ class QRCode(object):
                 if col + c <= -1 or self.moduleCount <= col + c:
                     continue
 
-                if (0 <= r <= 6 and (c == 0 or c == 6)) \
-                        or (0 <= c <= 6 and (r == 0 or r == 6)) \
-                        or (2 <= r <= 4 and 2 <= c <= 4):
-                    self.modules[row + r][col + c] = True
-                else:
-                    self.modules[row + r][col + c] = False
+                self.setModule(row + r, col + c,
+                               (0 <= r <= 6 and (c == 0 or c == 6))
+                               or (0 <= c <= 6 and (r == 0 or r == 6))
+                               or (2 <= r <= 4 and 2 <= c <= 4))
 
     def getBestMaskPattern(self):
 
+        if MASK_SCORER == "numpy":
+            masked = numpy.empty(
+                (8, self.typeNumber * 4 + 17, self.typeNumber * 4 + 17), dtype=numpy.int32)
+            for i in range(8):
+                self.makeImpl(True, i)
+                masked[i].flat = numpy.frombuffer(self.modules, dtype=numpy.uint8)
+
+            # argmin keeps the first of equal scores, like the loop below
+            return int(numpy.argmin(QRUtil.getLostPoints(masked)))
+
         minLostPoint = 0
         pattern = 0
 
@@ -202,83 +510,124 @@ class QRCode(object):
         """
         tl (etc) allow corners not to be rounded if 'rounding' is used
         """
-        # http://nadiana.com/pil-tutorial-basic-advanced-drawing
-        def round_corner(radius, fg, bg):
-            """Draw a round corner"""
-            corner = Image.new('RGBA', (radius, radius), bg)
+        mask = self.make_mask(block_in_pixels, border_in_blocks, rounding, tl, bl, br, tr)
 
-            draw = ImageDraw.Draw(corner)
-            draw.pieslice((0, 0, radius * 2, radius * 2), 180, 270, fill=fg)
+        im = Image.new(mode, mask.size, bg)
+        im.paste(fg, (0, 0) + mask.size, mask)
+
+        return im
 
-            return corner
+    def make_png(self, mode="1", **ad):
+        """make_image as PNG file contents, 1 bit deep by default"""
 
-        def round_rectangle(size, radius, fg, bg, tl=True, bl=True, br=True, tr=True):
-            """Draw a rounded rectangle"""
+        out = io.BytesIO()
+        self.make_image(mode=mode, **ad).save(out, "PNG")
 
-            width, height = size
-            corner = round_corner(radius, fg, bg)
+        return out.getvalue()
 
-            rectangle = Image.new('RGBA', size, fg)
-            if tl:
-                rectangle.paste(corner, (0, 0))
-            if bl:
-                # Rotate the corner and paste it
-                rectangle.paste(corner.rotate(90), (0, height - radius))
-            if br:
-                rectangle.paste(corner.rotate(180),
-                                (width - radius, height - radius))
-            if tr:
-                rectangle.paste(corner.rotate(270), (width - radius, 0))
+    def make_bitmap(self, block_in_pixels=1, border_in_blocks=4):
+        """Raw bitmap, 1 = dark, each row padded to a whole byte"""
 
-            return rectangle
+        mask = self.make_mask(block_in_pixels, border_in_blocks)
+
+        return mask.convert("1", dither=Image.NONE).tobytes()
+
+    def make_pbm(self, block_in_pixels=1, border_in_blocks=4):
+        """Binary (P4) PBM file contents"""
 
         pixelsize = (self.getModuleCount() + border_in_blocks +
                      border_in_blocks) * block_in_pixels
 
-        im = Image.new(mode, (pixelsize, pixelsize), bg)
-        d = ImageDraw.Draw(im)
+        return b"P4\n%d %d\n" % (pixelsize, pixelsize) + \
+            self.make_bitmap(block_in_pixels, border_in_blocks)
 
-        for r in range(self.getModuleCount()):
-            for c in range(self.getModuleCount()):
-                if not self.isDark(r, c):
-                    continue
+    def make_svg(self, bg="white", fg="black", block_in_pixels=10, border_in_blocks=4):
+        """
+        SVG document with every horizontal run of dark modules merged
+        into one rectangle of a single path
+        """
+        moduleCount = self.getModuleCount()
+        blocks = moduleCount + border_in_blocks + border_in_blocks
+
+        path = []
+        for r in range(moduleCount):
+            row = self.modules[r * moduleCount:(r + 1) * moduleCount]
+
+            start = row.find(b"\x01")
+            while start != -1:
+                end = row.find(b"\x00", start)
+                if end == -1:
+                    end = moduleCount
+                path.append("M%d %dh%dv1h-%dz" % (
+                    start + border_in_blocks, r + border_in_blocks, end - start, end - start))
+                start = row.find(b"\x01", end)
+
+        return (
+            '<svg xmlns="http://www.w3.org/2000/svg" width="%d" height="%d" viewBox="0 0 %d %d" shape-rendering="crispEdges">'
+            '<rect width="100%%" height="100%%" fill="%s"/>'
+            '<path fill="%s" d="%s"/>'
+            '</svg>') % (blocks * block_in_pixels, blocks * block_in_pixels, blocks, blocks,
+                         bg, fg, "".join(path))
+
+    def make_mask(self, block_in_pixels=10, border_in_blocks=4, rounding=0,
+                  tl=True, bl=True, br=True, tr=True):
+        """The symbol and its quiet zone as an "L" image, 255 where dark"""
+
+        moduleCount = self.getModuleCount()
+        size = moduleCount * block_in_pixels
+
+        # One pixel per module (255 = dark), scaled up in one go
+        mask = Image.frombytes("L", (moduleCount, moduleCount),
+                               bytes(self.modules.translate(MODULE_LEVELS)))
+        mask = mask.resize((size, size), Image.NEAREST)
+
+        if rounding > 0:
+            corners = getCornerSprites(rounding)
+
+            # Copy with a light border, so neighbours need no bounds checks
+            width = moduleCount + 2
+            padded = bytearray(width * width)
+            for r in range(moduleCount):
+                padded[(r + 1) * width + 1:(r + 2) * width - 1] = \
+                    self.modules[r * moduleCount:(r + 1) * moduleCount]
+
+            for r in range(moduleCount):
+                for c in range(moduleCount):
+                    i = (r + 1) * width + c + 1
+                    if not padded[i]:
+                        continue
 
-                x = (c + border_in_blocks) * block_in_pixels
-                y = (r + border_in_blocks) * block_in_pixels
-                b = [(x, y), (x + block_in_pixels, y + block_in_pixels)]
-
-                if rounding > 0:
-                    rr = round_rectangle(
-                        (block_in_pixels, block_in_pixels, ),
-                        rounding,
-                        fg, bg,
-                        tl=not (self.isDark(r - 1, c)
-                                or self.isDark(r, c - 1)) and tl,
-                        bl=not (self.isDark(r, c - 1)
-                                or self.isDark(r + 1, c)) and bl,
-                        tr=not (self.isDark(r - 1, c)
-                                or self.isDark(r, c + 1)) and tr,
-                        br=not (self.isDark(r + 1, c)
-                                or self.isDark(r, c + 1)) and br,
-                    )
-                    im.paste(rr, (x, y))
-                    pass
-                else:
-                    d.rectangle(b, fill=fg)
-        del d
-        return im
+                    up = padded[i - width]
+                    down = padded[i + width]
+                    left = padded[i - 1]
+                    right = padded[i + 1]
+
+                    x = c * block_in_pixels
+                    y = r * block_in_pixels
+
+                    if tl and not (up or left):
+                        mask.paste(corners[0], (x, y))
+                    if bl and not (left or down):
+                        mask.paste(corners[1], (x, y + block_in_pixels - rounding))
+                    if br and not (down or right):
+                        mask.paste(corners[2], (x + block_in_pixels - rounding,
+                                                y + block_in_pixels - rounding))
+                    if tr and not (up or right):
+                        mask.paste(corners[3], (x + block_in_pixels - rounding, y))
+
+        return ImageOps.expand(mask, border_in_blocks * block_in_pixels, 0)
 
     def setupTimingPattern(self):
 
         for r in range(8, self.moduleCount - 8):
-            if not self.modules[r][6] is None:
+            if self.reserved[r * self.moduleCount + 6]:
                 continue
-            self.modules[r][6] = (r % 2 == 0)
+            self.setModule(r, 6, r % 2 == 0)
 
         for c in range(8, self.moduleCount - 8):
-            if not self.modules[6][c] is None:
+            if self.reserved[6 * self.moduleCount + c]:
                 continue
-            self.modules[6][c] = (c % 2 == 0)
+            self.setModule(6, c, c % 2 == 0)
 
     def setupPositionAdjustPattern(self):
 
@@ -290,17 +639,15 @@ class QRCode(object):
                 row = pos[i]
                 col = pos[j]
 
-                if not self.modules[row][col] is None:
+                if self.reserved[row * self.moduleCount + col]:
                     continue
 
                 for r in range(-2, 3):
 
                     for c in range(-2, 3):
 
-                        if r == -2 or r == 2 or c == -2 or c == 2 or (r == 0 and c == 0):
-                            self.modules[row + r][col + c] = True
-                        else:
-                            self.modules[row + r][col + c] = False
+                        self.setModule(row + r, col + c,
+                                       r == -2 or r == 2 or c == -2 or c == 2 or (r == 0 and c == 0))
 
     def setupTypeNumber(self, test):
 
@@ -308,11 +655,11 @@ class QRCode(object):
 
         for i in range(18):
             mod = (not test and ((bits >> i) & 1) == 1)
-            self.modules[i // 3][i % 3 + self.moduleCount - 8 - 3] = mod
+            self.setModule(i // 3, i % 3 + self.moduleCount - 8 - 3, mod)
 
         for i in range(18):
             mod = (not test and ((bits >> i) & 1) == 1)
-            self.modules[i % 3 + self.moduleCount - 8 - 3][i // 3] = mod
+            self.setModule(i % 3 + self.moduleCount - 8 - 3, i // 3, mod)
 
     def setupTypeInfo(self, test, maskPattern):
 
@@ -324,75 +671,70 @@ class QRCode(object):
             mod = (not test and ((bits >> i) & 1) == 1)
 
             if i < 6:
-                self.modules[i][8] = mod
+                self.setModule(i, 8, mod)
             elif i < 8:
-                self.modules[i + 1][8] = mod
+                self.setModule(i + 1, 8, mod)
             else:
-                self.modules[self.moduleCount - 15 + i][8] = mod
+                self.setModule(self.moduleCount - 15 + i, 8, mod)
 
         #// horizontal
         for i in range(15):
             mod = (not test and ((bits >> i) & 1) == 1)
 
             if i < 8:
-                self.modules[8][self.moduleCount - i - 1] = mod
+                self.setModule(8, self.moduleCount - i - 1, mod)
             elif i < 9:
-                self.modules[8][15 - i - 1 + 1] = mod
+                self.setModule(8, 15 - i - 1 + 1, mod)
             else:
-                self.modules[8][15 - i - 1] = mod
+                self.setModule(8, 15 - i - 1, mod)
 
         #// fixed module
-        self.modules[self.moduleCount - 8][8] = (not test)
+        self.setModule(self.moduleCount - 8, 8, not test)
 
     def mapData(self, data, maskPattern):
 
-        inc = -1
-        row = self.moduleCount - 1
-        bitIndex = 7
-        byteIndex = 0
+        order, maskBits = QRUtil.getDataPlacement(self.typeNumber)
 
-        for col in range(self.moduleCount - 1, 0, -2):
+        if numpy is not None:
+            bits = numpy.zeros(len(order), dtype=numpy.uint8)
+            dataBits = numpy.unpackbits(numpy.frombuffer(data, dtype=numpy.uint8))[:len(order)]
+            bits[:len(dataBits)] = dataBits
 
-            if col == 6:
-                col -= 1
-
-            while True:
-
-                for c in range(2):
-                    if self.modules[row][col - c] is None:
-
-                        dark = False
-
-                        if byteIndex < len(data):
-                            dark = (((data[byteIndex] >> bitIndex) & 1) == 1)
-
-                        mask = QRUtil.getMask(maskPattern, row, col - c)
-
-                        if mask:
-                            dark = not dark
+            modules = numpy.frombuffer(self.modules, dtype=numpy.uint8)
+            modules[order] = bits ^ maskBits[maskPattern]
+            return
 
-                        self.modules[row][col - c] = dark
-                        bitIndex -= 1
+        bits = bytearray().join(BYTE_BITS[b] for b in data)
+        modules = self.modules
+        for index, bit, mask in zip(order, bits, maskBits[maskPattern]):
+            modules[index] = bit ^ mask
 
-                        if bitIndex == -1:
-                            byteIndex += 1
-                            bitIndex = 7
+        #// remainder bits past the data are light before masking
+        for index, mask in zip(order[len(bits):], maskBits[maskPattern][len(bits):]):
+            modules[index] = mask
 
-                row += inc
-
-                if row < 0 or self.moduleCount <= row:
-                    row -= inc
-                    inc = -inc
-                    break
     PAD0 = 0xEC
     PAD1 = 0x11
 
+    #// enough alternating pad codewords for the largest symbol
+    PAD_BYTES = bytearray([PAD0, PAD1] * 1500)
+
     @staticmethod
     def createData(typeNumber, errorCorrectLevel, dataList):
 
         rsBlocks = QRRSBlock.getRSBlocks(typeNumber, errorCorrectLevel)
+        buffer = QRCode.createBuffer(typeNumber, rsBlocks, dataList)
 
-        buffer = QRBitBuffer()
+        return QRCode.createBytes(buffer, rsBlocks)
+
+    @staticmethod
+    def createBuffer(typeNumber, rsBlocks, dataList):
+        """The data codewords, terminated and padded, as a QRBitBuffer"""
+
+        #// calc num max data.
+        totalDataCount = sum([x.dataCount for x in rsBlocks])
+
+        buffer = QRBitBuffer(totalDataCount)
 
         for i in range(len(dataList)):
             data = dataList[i]
@@ -401,9 +743,6 @@ class QRCode(object):
                        QRUtil.getLengthInBits(data.mode, typeNumber))
             data.write(buffer)
 
-        #// calc num max data.
-        totalDataCount = sum([x.dataCount for x in rsBlocks])
-
         if buffer.getLengthInBits() > totalDataCount * 8:
             raise CodeLengthOverflowError(
                 bits=buffer.getLengthInBits(), maxbits=totalDataCount * 8)
@@ -413,25 +752,18 @@ class QRCode(object):
             buffer.put(0, 4)
 
         #// padding
-        while buffer.getLengthInBits() % 8 != 0:
-            buffer.putBit(False)
+        buffer.put(0, -buffer.getLengthInBits() % 8)
 
         #// padding
-        while True:
-
-            if buffer.getLengthInBits() >= totalDataCount * 8:
-                break
-            buffer.put(QRCode.PAD0, 8)
+        padCount = totalDataCount - buffer.getLengthInBits() // 8
+        buffer.putBytes(QRCode.PAD_BYTES[:padCount])
 
-            if buffer.getLengthInBits() >= totalDataCount * 8:
-                break
-            buffer.put(QRCode.PAD1, 8)
-
-        return QRCode.createBytes(buffer, rsBlocks)
+        return buffer
 
     @staticmethod
     def createBytes(buffer, rsBlocks):
 
+        codewords = buffer.getBytes()
         offset = 0
 
         maxDcCount = 0
@@ -449,10 +781,13 @@ class QRCode(object):
             maxDcCount = max(maxDcCount, dcCount)
             maxEcCount = max(maxEcCount, ecCount)
 
-            dcdata[r] = [0xff & buffer.buffer[i + offset]
-                         for i in range(dcCount)]
+            dcdata[r] = bytearray(codewords[offset:offset + dcCount])
             offset += dcCount
 
+            if RS_ENGINE == "table":
+                ecdata[r] = QRReedSolomon.getRemainder(dcdata[r], ecCount)
+                continue
+
             rsPoly = QRUtil.getErrorCorrectPolynomial(ecCount)
             rawPoly = QRPolynomial(dcdata[r], rsPoly.getLength() - 1)
 
@@ -465,10 +800,10 @@ class QRCode(object):
                 else:
                     ecdata[r][i] = 0
 
-        data = [dcdata[r][i]
-                for i in range(maxDcCount) for r in range(rsbLen) if i < len(dcdata[r])]
-        data.extend([ecdata[r][i] for i in range(maxEcCount)
-                    for r in range(rsbLen) if i < len(ecdata[r])])
+        data = bytearray(dcdata[r][i]
+                         for i in range(maxDcCount) for r in range(rsbLen) if i < len(dcdata[r]))
+        data.extend(ecdata[r][i] for i in range(maxEcCount)
+                    for r in range(rsbLen) if i < len(ecdata[r]))
 
         return data
 
@@ -574,7 +909,7 @@ class QRUtil(object):
         if maskPattern == QRMaskPattern.PATTERN011:
             return (i + j) % 3 == 0
         if maskPattern == QRMaskPattern.PATTERN100:
-            return (math.floor(i / 2) + math.floor(j / 3)) % 2 == 0
+            return (i // 2 + j // 3) % 2 == 0
         if maskPattern == QRMaskPattern.PATTERN101:
             return (i * j) % 2 + (i * j) % 3 == 0
         if maskPattern == QRMaskPattern.PATTERN110:
@@ -583,16 +918,231 @@ class QRUtil(object):
             return ((i * j) % 3 + (i + j) % 2) % 2 == 0
         raise Exception("bad maskPattern:" + maskPattern)
 
+    #
+    #	Placement order and masks only depend on the version, so they are
+    #	built once per typeNumber
+    #
+    DATA_PLACEMENT = {}
+
+    @staticmethod
+    def getDataPlacement(typeNumber):
+        """
+        (order, maskBits) for a version: the indexes of the data modules in
+        placement order, and for each mask pattern whether it inverts the
+        module at each of those positions. numpy arrays when numpy is
+        available, otherwise a list and bytearrays.
+        """
+        placement = QRUtil.DATA_PLACEMENT.get(typeNumber)
+        if placement is not None:
+            return placement
+
+        moduleCount = typeNumber * 4 + 17
+        reserved = QRCode.getFunctionPatterns(typeNumber, False)[1]
+
+        order = []
+        positions = []
+
+        inc = -1
+        row = moduleCount - 1
+
+        #// the timing column shifts every following column pair left
+        col = moduleCount - 1
+        while col > 0:
+
+            if col == 6:
+                col -= 1
+
+            while True:
+
+                for c in range(2):
+                    if not reserved[row * moduleCount + col - c]:
+                        order.append(row * moduleCount + col - c)
+                        positions.append((row, col - c))
+
+                row += inc
+
+                if row < 0 or moduleCount <= row:
+                    row -= inc
+                    inc = -inc
+                    break
+
+            col -= 2
+
+        maskBits = [bytearray(1 if QRUtil.getMask(maskPattern, i, j) else 0 for i, j in positions)
+                    for maskPattern in range(8)]
+
+        if numpy is not None:
+            order = numpy.array(order, dtype=numpy.intp)
+            maskBits = [numpy.frombuffer(bytes(m), dtype=numpy.uint8) for m in maskBits]
+
+        placement = (order, maskBits)
+        QRUtil.DATA_PLACEMENT[typeNumber] = placement
+        return placement
+
+    #
+    #	Generator polynomials only depend on the number of EC codewords,
+    #	so they are built once and shared by every QRCode
+    #
+    RS_POLY_CACHE = {}
+
     @staticmethod
     def getErrorCorrectPolynomial(errorCorrectLength):
+        a = QRUtil.RS_POLY_CACHE.get(errorCorrectLength)
+        if a is not None:
+            return a
+
         a = QRPolynomial([1], 0)
         for i in range(errorCorrectLength):
             a = a.multiply(QRPolynomial([1, QRMath.gexp(i)], 0))
+
+        QRUtil.RS_POLY_CACHE[errorCorrectLength] = a
         return a
 
+    #// segment modes, classes and cost per character in sixths of a bit
+    SEGMENT_MODES = [
+        (QRMode.MODE_NUMBER, QRNumber, 20),
+        (QRMode.MODE_ALPHA_NUM, QRAlphaNum, 33),
+        (QRMode.MODE_8BIT_BYTE, QR8bitByte, 48),
+    ]
+
+    @staticmethod
+    def canEncode(mode, c):
+        if mode == QRMode.MODE_NUMBER:
+            return "0" <= c <= "9"
+        if mode == QRMode.MODE_ALPHA_NUM:
+            return c in QRAlphaNum.CODES
+        return True
+
+    @staticmethod
+    def getSegments(data, typeNumber):
+        """
+        Split 'data' into the list of QRNumber, QRAlphaNum and QR8bitByte
+        segments with the fewest bits at this version, by dynamic
+        programming over the mode of each character.
+        """
+        if len(data) == 0:
+            return [QR8bitByte(data)]
+
+        modes = [mode for mode, _, _ in QRUtil.SEGMENT_MODES]
+        charCosts = [charCost for _, _, charCost in QRUtil.SEGMENT_MODES]
+        headCosts = [(4 + QRUtil.getLengthInBits(mode, typeNumber)) * 6 for mode in modes]
+        modeRange = range(len(modes))
+
+        # Modes that can hold each distinct character
+        encodable = {}
+        for c in set(data):
+            encodable[c] = [k for k in modeRange if QRUtil.canEncode(modes[k], c)]
+
+        # costs[k]: cheapest encoding so far with the current segment in
+        # mode k; charModes[i][k]: mode of character i on that path
+        costs = headCosts
+        charModes = []
+
+        for c in data:
+            newCosts = [None] * len(modes)
+            newModes = [None] * len(modes)
+
+            ks = encodable[c]
+            for k in ks:
+                newCosts[k] = costs[k] + charCosts[k]
+                newModes[k] = k
+
+            # Switching after this character rounds up to whole bits
+            for j in modeRange:
+                headCost = headCosts[j]
+                for k in modeRange:
+                    if newModes[k] is None:
+                        continue
+                    switchCost = (newCosts[k] + 5) // 6 * 6 + headCost
+                    if newCosts[j] is None or switchCost < newCosts[j]:
+                        newCosts[j] = switchCost
+                        newModes[j] = k
+
+            costs = newCosts
+            charModes.append(newModes)
+
+        # Walk back from the cheapest final mode
+        k = min(range(len(modes)), key=lambda m: costs[m])
+        perChar = []
+        for newModes in reversed(charModes):
+            k = newModes[k]
+            perChar.append(k)
+        perChar.reverse()
+
+        segments = []
+        start = 0
+        for i in range(1, len(data) + 1):
+            if i == len(data) or perChar[i] != perChar[start]:
+                segmentClass = QRUtil.SEGMENT_MODES[perChar[start]][1]
+                segments.append(segmentClass(data[start:i]))
+                start = i
+
+        return segments
+
+    @staticmethod
+    def getBestSegments(data, errorCorrectLevel, minTypeNumber=0):
+        """(segments, typeNumber) for the smallest symbol that holds data"""
+
+        digits = sum(data.count(c) for c in "0123456789")
+        alphaNums = sum(data.count(c) for c in QRAlphaNum.CHARS) - digits
+
+        # All digits: one numeric segment is best at every version
+        if data and digits == len(data):
+            segments = [QRNumber(data)]
+            return segments, QRUtil.getTypeNumber(segments, errorCorrectLevel, minTypeNumber)
+
+        # No encoding of data takes fewer bits than each character in its
+        # cheapest mode, in sixths of a bit as in SEGMENT_MODES
+        minBits = (digits * 20 + alphaNums * 33 + (len(data) - digits - alphaNums) * 48) // 6 + 4
+
+        #
+        #	The best segmentation depends on the length field sizes, which
+        #	change at versions 10 and 27, so try each range in turn,
+        #	skipping ranges that cannot hold minBits
+        #
+        for firstTypeNumber, lastTypeNumber in [(1, 9), (10, 26), (27, 40)]:
+            if minTypeNumber > lastTypeNumber:
+                continue
+            if lastTypeNumber < 40 and \
+                    minBits > QRRSBlock.getDataCount(lastTypeNumber, errorCorrectLevel) * 8:
+                continue
+
+            segments = QRUtil.getSegments(data, firstTypeNumber)
+            typeNumber = QRUtil.getTypeNumber(segments, errorCorrectLevel,
+                                              max(minTypeNumber, firstTypeNumber))
+            if typeNumber <= lastTypeNumber:
+                break
+
+        return segments, typeNumber
+
+    @staticmethod
+    def getTypeNumber(dataList, errorCorrectLevel, minTypeNumber=0):
+        """The smallest typeNumber, from minTypeNumber up, that holds dataList"""
+
+        bits = 0
+        maxbits = 0
+
+        for typeNumber in range(max(minTypeNumber, 1), 41):
+            bits = 0
+            for data in dataList:
+                lengthBits = QRUtil.getLengthInBits(data.mode, typeNumber)
+                if data.getLength() >= 1 << lengthBits:
+                    break
+                bits += 4 + lengthBits + data.getLengthInBits()
+            else:
+                maxbits = QRRSBlock.getDataCount(typeNumber, errorCorrectLevel) * 8
+                if bits <= maxbits:
+                    return typeNumber
+
+        raise CodeLengthOverflowError(bits=bits, maxbits=maxbits)
+
     @staticmethod
     def getLengthInBits(mode, type):
 
+        #// symbol index and count
+        if mode == QRMode.MODE_STRUCTURED_APPEND:
+            return 8
+
         if 1 <= type < 10:
 
             #// 1 - 9
@@ -638,30 +1188,31 @@ class QRUtil(object):
         else:
             raise Exception("type:" + type)
 
+    #// dark-light-dark-dark-dark-light-dark, as in the finder patterns
+    FINDER_LIKE_PATTERN = bytearray([1, 0, 1, 1, 1, 0, 1])
+
     @staticmethod
     def getLostPoint(qrCode):
 
         moduleCount = qrCode.getModuleCount()
+        modules = qrCode.modules
         lostPoint = 0
 
         #// LEVEL1
 
         for row in range(moduleCount):
+            rowRange = range(max(row - 1, 0), min(row + 2, moduleCount))
 
             for col in range(moduleCount):
-                sameCount = 0
-                dark = qrCode.isDark(row, col)
-
-                for r in range(-1, 2):
-                    if row + r < 0 or moduleCount <= row + r:
-                        continue
-
-                    for c in range(-1, 2):
-                        if col + c < 0 or moduleCount <= col + c:
-                            continue
-                        if r == 0 and c == 0:
-                            continue
-                        if dark == qrCode.isDark(row + r, col + c):
+                # The module itself is always counted, so start at -1
+                sameCount = -1
+                dark = modules[row * moduleCount + col]
+                colStart = max(col - 1, 0)
+                colEnd = min(col + 2, moduleCount)
+
+                for r in rowRange:
+                    for index in range(r * moduleCount + colStart, r * moduleCount + colEnd):
+                        if modules[index] == dark:
                             sameCount += 1
 
                 if sameCount > 5:
@@ -669,57 +1220,82 @@ class QRUtil(object):
 
         #// LEVEL2
         for row in range(moduleCount - 1):
-            for col in range(moduleCount - 1):
-                count = 0
-                if qrCode.isDark(row, col):
-                    count += 1
-                if qrCode.isDark(row + 1, col):
-                    count += 1
-                if qrCode.isDark(row, col + 1):
-                    count += 1
-                if qrCode.isDark(row + 1, col + 1):
-                    count += 1
+            for index in range(row * moduleCount, (row + 1) * moduleCount - 1):
+                count = modules[index] + modules[index + 1] \
+                    + modules[index + moduleCount] + modules[index + moduleCount + 1]
                 if count == 0 or count == 4:
                     lostPoint += 3
 
         #// LEVEL3
 
-        for row in range(moduleCount):
-            for col in range(moduleCount - 6):
-                if (qrCode.isDark(row, col)
-                    and not qrCode.isDark(row, col + 1)
-                    and qrCode.isDark(row, col + 2)
-                    and qrCode.isDark(row, col + 3)
-                    and qrCode.isDark(row, col + 4)
-                    and not qrCode.isDark(row, col + 5)
-                        and qrCode.isDark(row, col + 6)):
-                    lostPoint += 40
-
-        for col in range(moduleCount):
-            for row in range(moduleCount - 6):
-                if (qrCode.isDark(row, col)
-                    and not qrCode.isDark(row + 1, col)
-                    and qrCode.isDark(row + 2, col)
-                    and qrCode.isDark(row + 3, col)
-                    and qrCode.isDark(row + 4, col)
-                    and not qrCode.isDark(row + 5, col)
-                        and qrCode.isDark(row + 6, col)):
-                    lostPoint += 40
+        lines = [modules[row * moduleCount:(row + 1) * moduleCount]
+                 for row in range(moduleCount)]
+        lines.extend(modules[col::moduleCount] for col in range(moduleCount))
 
-        #// LEVEL4
+        for line in lines:
+            index = line.find(QRUtil.FINDER_LIKE_PATTERN)
+            while index != -1:
+                lostPoint += 40
+                index = line.find(QRUtil.FINDER_LIKE_PATTERN, index + 1)
 
-        darkCount = 0
+        #// LEVEL4
 
-        for col in range(moduleCount):
-            for row in range(moduleCount):
-                if qrCode.isDark(row, col):
-                    darkCount += 1
+        darkCount = sum(modules)
 
         ratio = abs(100 * darkCount / moduleCount / moduleCount - 50) / 5
         lostPoint += ratio * 10
 
         return lostPoint
 
+    @staticmethod
+    def getLostPoints(masked):
+        """
+        getLostPoint for a stack of symbols at once: 'masked' is a
+        (count, moduleCount, moduleCount) int array of 0/1 modules and one
+        score per symbol is returned. Requires numpy.
+        """
+
+        count, n, _ = masked.shape
+
+        #// LEVEL1
+
+        # Dark neighbours and in-bounds neighbours from 3x3 window sums
+        padded = numpy.zeros((count, n + 2, n + 2), dtype=numpy.int32)
+        padded[:, 1:-1, 1:-1] = masked
+        inside = numpy.zeros((n + 2, n + 2), dtype=numpy.int32)
+        inside[1:-1, 1:-1] = 1
+
+        darkNeighbours = -masked
+        neighbours = -1
+        for r in range(3):
+            for c in range(3):
+                darkNeighbours = darkNeighbours + padded[:, r:r + n, c:c + n]
+                neighbours = neighbours + inside[r:r + n, c:c + n]
+
+        sameCount = numpy.where(masked == 1, darkNeighbours, neighbours - darkNeighbours)
+        lostPoints = numpy.where(sameCount > 5, sameCount - 2, 0).sum(axis=(1, 2))
+
+        #// LEVEL2
+
+        blocks = masked[:, :-1, :-1] + masked[:, 1:, :-1] \
+            + masked[:, :-1, 1:] + masked[:, 1:, 1:]
+        lostPoints += 3 * ((blocks == 0) | (blocks == 4)).sum(axis=(1, 2))
+
+        #// LEVEL3
+
+        for lines in (masked, masked.transpose(0, 2, 1)):
+            found = numpy.ones((count, n, n - 6), dtype=bool)
+            for i, dark in enumerate(QRUtil.FINDER_LIKE_PATTERN):
+                found &= lines[:, :, i:i + n - 6] == dark
+            lostPoints += 40 * found.sum(axis=(1, 2))
+
+        #// LEVEL4
+
+        darkCount = masked.sum(axis=(1, 2))
+        lostPoints += abs(100 * darkCount // n // n - 50) // 5 * 10
+
+        return lostPoints
+
 
 class QRMath:
 
@@ -731,11 +1307,7 @@ class QRMath:
 
     @staticmethod
     def gexp(n):
-        while n < 0:
-            n += 255
-        while n >= 256:
-            n -= 255
-        return EXP_TABLE[n]
+        return EXP_TABLE[n % 255]
 
 EXP_TABLE = [x for x in range(256)]
 
@@ -751,6 +1323,42 @@ for i in range(8, 256):
 for i in range(255):
     LOG_TABLE[EXP_TABLE[i]] = i
 
+#
+#	Doubled antilog table, so glog(a) + glog(b) never needs reducing
+#
+EXP_TABLE2 = EXP_TABLE[:255] * 2
+
+#
+#	Bits of each byte value, most significant first
+#
+BYTE_BITS = [bytearray([(b >> (7 - i)) & 1 for i in range(8)]) for b in range(256)]
+
+#
+#	QRCode.modules to 8 bit grey levels, dark = 255
+#
+MODULE_LEVELS = bytearray([0, 255] + [0] * 254)
+
+#
+#	Rounded corner masks per radius, in tl, bl, br, tr order
+#
+CORNER_SPRITES = {}
+
+
+def getCornerSprites(radius):
+    sprites = CORNER_SPRITES.get(radius)
+    if sprites is not None:
+        return sprites
+
+    # http://nadiana.com/pil-tutorial-basic-advanced-drawing
+    corner = Image.new("L", (radius, radius), 0)
+    draw = ImageDraw.Draw(corner)
+    draw.pieslice((0, 0, radius * 2, radius * 2), 180, 270, fill=255)
+    del draw
+
+    sprites = [corner, corner.rotate(90), corner.rotate(180), corner.rotate(270)]
+    CORNER_SPRITES[radius] = sprites
+    return sprites
+
 
 class QRPolynomial:
 
@@ -798,6 +1406,54 @@ class QRPolynomial:
         return QRPolynomial(num, 0).mod(e)
 
 
+class QRReedSolomon:
+    """
+    Iterative, table-driven Reed-Solomon remainder (LFSR form).
+
+    For every EC length a 256 entry table holds the generator multiplied
+    by each possible feedback byte, packed big-endian into one int, so
+    each data codeword costs a single shift and XOR.
+    """
+
+    FEEDBACK_TABLES = {}
+
+    @staticmethod
+    def getFeedbackTable(ecCount):
+        table = QRReedSolomon.FEEDBACK_TABLES.get(ecCount)
+        if table is not None:
+            return table
+
+        rsPoly = QRUtil.getErrorCorrectPolynomial(ecCount)
+        generator = [rsPoly.get(i) for i in range(1, ecCount + 1)]
+
+        table = [0] * 256
+        for factor in range(1, 256):
+            logFactor = LOG_TABLE[factor]
+            row = 0
+            for g in generator:
+                row <<= 8
+                if g != 0:
+                    row |= EXP_TABLE2[LOG_TABLE[g] + logFactor]
+            table[factor] = row
+
+        QRReedSolomon.FEEDBACK_TABLES[ecCount] = table
+        return table
+
+    @staticmethod
+    def getRemainder(data, ecCount):
+        """EC codewords for 'data' as a bytearray of length ecCount"""
+        table = QRReedSolomon.getFeedbackTable(ecCount)
+        shift = (ecCount - 1) * 8
+        mask = (1 << (ecCount * 8)) - 1
+
+        register = 0
+        for b in data:
+            register = ((register << 8) & mask) ^ table[b ^ (register >> shift)]
+
+        return bytearray((register >> (8 * i)) & 0xff
+                         for i in range(ecCount - 1, -1, -1))
+
+
 class QRRSBlock:
 
     RS_BLOCK_TABLE = [
@@ -895,7 +1551,7 @@ class QRRSBlock:
         [5, 109, 87, 1, 110, 88],
         [5, 65, 41, 5, 66, 42],
         [5, 54, 24, 7, 55, 25],
-        [11, 36, 12],
+        [11, 36, 12, 7, 37, 13],
 
         # 16
         [5, 122, 98, 1, 123, 99],
@@ -1075,6 +1731,12 @@ class QRRSBlock:
 
         return l
 
+    @staticmethod
+    def getDataCount(typeNumber, errorCorrectLevel):
+        """Total data codewords of a symbol, straight from the table"""
+        rsBlock = QRRSBlock.getRsBlockTable(typeNumber, errorCorrectLevel)
+        return sum([rsBlock[i] * rsBlock[i + 2] for i in range(0, len(rsBlock), 3)])
+
     @staticmethod
     def getRsBlockTable(typeNumber, errorCorrectLevel):
         if errorCorrectLevel == QRErrorCorrectLevel.L:
@@ -1090,31 +1752,64 @@ class QRRSBlock:
 
 
 class QRBitBuffer:
+    """
+    Big-endian bit buffer over a bytearray.
 
-    def __init__(self):
-        self.buffer = []
+    Fields are written whole with integer shifts rather than bit by bit;
+    'capacity' preallocates the buffer (in bytes) so a symbol's data
+    codewords are written in place.
+    """
+
+    def __init__(self, capacity=0):
+        self.buffer = bytearray(capacity)
         self.length = 0
 
     def __repr__(self):
-        return ".".join([str(n) for n in self.buffer])
+        return ".".join([str(n) for n in self.getBytes()])
 
     def get(self, index):
-        bufIndex = int(math.floor(index / 8))
-        val = ((self.buffer[bufIndex] >> (7 - index % 8)) & 1) == 1
-        print "get ", val
-        return ((self.buffer[bufIndex] >> (7 - index % 8)) & 1) == 1
+        return ((self.buffer[index // 8] >> (7 - index % 8)) & 1) == 1
+
+    def getBytes(self):
+        """The written bytes, as a memoryview onto the buffer (no copy)"""
+        return memoryview(self.buffer)[:(self.length + 7) // 8]
+
+    def ensureCapacity(self, byteCount):
+        if len(self.buffer) < byteCount:
+            self.buffer.extend(bytearray(byteCount - len(self.buffer)))
 
     def put(self, num, length):
-        for i in range(length):
-            self.putBit(((num >> (length - i - 1)) & 1) == 1)
+        if length <= 0:
+            return
+
+        start = self.length // 8
+        end = (self.length + length + 7) // 8
+        self.ensureCapacity(end)
+
+        # Align the field's last bit with the end of its last byte; bytes
+        # past self.length are always zero, so only the first is merged
+        num = (num & ((1 << length) - 1)) << (-(self.length + length) % 8)
+        chunk = bytearray.fromhex("%0*x" % ((end - start) * 2, num))
+        chunk[0] |= self.buffer[start]
+        self.buffer[start:end] = chunk
+
+        self.length += length
+
+    def putBytes(self, data):
+        if len(data) == 0:
+            return
+
+        if self.length % 8 != 0:
+            self.put(int(binascii.hexlify(data), 16), len(data) * 8)
+            return
+
+        start = self.length // 8
+        self.ensureCapacity(start + len(data))
+        self.buffer[start:start + len(data)] = data
+        self.length += len(data) * 8
 
     def getLengthInBits(self):
         return self.length
 
     def putBit(self, bit):
-        bufIndex = self.length // 8
-        if len(self.buffer) <= bufIndex:
-            self.buffer.append(0)
-        if bit:
-            self.buffer[bufIndex] |= (0x80 >> (self.length % 8))
-        self.length += 1
+        self.put(1 if bit else 0, 1)
@@ -0,0 +1,375 @@
+#
+#	server.py
+#
+#	Sticker rendering service for back-office systems, no Qt needed
+#
+#	python server.py [--port 8080 | --socket /tmp/stickers.sock] [--processes N]
+#
+#	POST /sticker   JSON {"schedule": {...}}, {"regimen": [{...}, ...]} or
+#	                {"data": "..."}, with optional "format" ("png" or "pbm"),
+#	                "block" (pixels per module) and "level" (L, M, Q or H)
+#	GET  /metrics   request counts, batch sizes and latency percentiles as JSON
+#
+#	Concurrent requests are collected into batches (up to --batch-size, or
+#	whatever arrived within --batch-wait ms of the first) and each batch is
+#	split across the processes of a pool. Every response reports its own
+#	queue (until its encoding started), render and total time in X-Queue-Ms,
+#	X-Render-Ms and X-Latency-Ms.
+#
+
+import argparse
+import BaseHTTPServer
+import collections
+import io
+import json
+import multiprocessing
+import os
+import Queue
+import SocketServer
+import sys
+import threading
+import time
+
+import payload
+import pyqrcode
+
+LEVELS = {
+    "L": pyqrcode.QRErrorCorrectLevel.L,
+    "M": pyqrcode.QRErrorCorrectLevel.M,
+    "Q": pyqrcode.QRErrorCorrectLevel.Q,
+    "H": pyqrcode.QRErrorCorrectLevel.H,
+}
+
+CONTENT_TYPES = {
+    "png": "image/png",
+    "pbm": "image/x-portable-bitmap",
+}
+
+
+def renderSticker(request):
+    """PNG or PBM bytes for one validated request dict"""
+
+    level = LEVELS[request["level"]]
+    method = "make_" + request["format"]
+
+    if "regimen" in request:
+        image = pyqrcode.MakeQRSequenceImage(
+            payload.encodeRegimen(request["regimen"]), errorCorrectLevel=level,
+            mode="1", block_in_pixels=request["block"])
+        out = io.BytesIO()
+        # PIL writes mode "1" images as binary PBM
+        image.save(out, "PNG" if request["format"] == "png" else "PPM")
+        return out.getvalue()
+
+    if "schedule" in request:
+        data = payload.encodeSchedule(request["schedule"])
+    else:
+        data = request["data"]
+
+    # Each worker process keeps its own cache of recent symbols
+    return pyqrcode.QR_CACHE.getRender(method, data, errorCorrectLevel=level,
+                                       block_in_pixels=request["block"])
+
+
+def renderStickers(requests):
+    """
+    Worker entry point: (error, bytes, started, seconds) per request, so one
+    bad request does not fail the rest of its chunk
+    """
+    results = []
+    for request in requests:
+        start = time.time()
+        try:
+            results.append((None, renderSticker(request), start, time.time() - start))
+        except Exception, e:
+            results.append((str(e), None, start, time.time() - start))
+    return results
+
+
+def parseRequest(body):
+    """Validate a /sticker JSON body, filling in defaults; raises ValueError"""
+
+    try:
+        request = json.loads(body)
+    except ValueError:
+        raise ValueError("body is not JSON")
+
+    if not isinstance(request, dict):
+        raise ValueError("body must be a JSON object")
+
+    kinds = [kind for kind in ["schedule", "regimen", "data"] if kind in request]
+    if len(kinds) != 1:
+        raise ValueError("give exactly one of schedule, regimen or data")
+
+    if "data" in request:
+        if not isinstance(request["data"], basestring):
+            raise ValueError("data must be a string")
+        request["data"] = request["data"].encode("utf-8")
+    elif "schedule" in request and not isinstance(request["schedule"], dict):
+        raise ValueError("schedule must be an object")
+    elif "regimen" in request and not (isinstance(request["regimen"], list) and request["regimen"]):
+        raise ValueError("regimen must be a non-empty list")
+
+    request.setdefault("format", "png")
+    request.setdefault("level", "M")
+    request.setdefault("block", 10)
+
+    if request["format"] not in CONTENT_TYPES:
+        raise ValueError("format must be png or pbm")
+    if request["level"] not in LEVELS:
+        raise ValueError("level must be L, M, Q or H")
+    if not isinstance(request["block"], int) or not 1 <= request["block"] <= 50:
+        raise ValueError("block must be 1-50")
+
+    return request
+
+
+class StickerJob(object):
+
+    def __init__(self, request):
+        self.request = request
+        self.done = threading.Event()
+        self.error = None
+        self.result = None
+        self.created = time.time()
+        self.started = None
+        self.renderSeconds = 0.0
+
+
+class StickerMetrics(object):
+    """Counters plus latencies of the last 'window' requests"""
+
+    def __init__(self, window=1000):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.requests = 0
+        self.errors = 0
+        self.batches = 0
+        self.batched = 0
+        self.latencies = collections.deque(maxlen=window)
+        self.queueTimes = collections.deque(maxlen=window)
+        self.renderTimes = collections.deque(maxlen=window)
+
+    def addBatch(self, size):
+        with self.lock:
+            self.batches += 1
+            self.batched += size
+
+    def addRequest(self, error, queueSeconds, renderSeconds, latencySeconds):
+        with self.lock:
+            self.requests += 1
+            if error is not None:
+                self.errors += 1
+            self.latencies.append(latencySeconds)
+            self.queueTimes.append(queueSeconds)
+            self.renderTimes.append(renderSeconds)
+
+    @staticmethod
+    def getPercentiles(values):
+        values = sorted(values)
+        if not values:
+            return {}
+        return dict(("p%d" % p, round(values[min(len(values) - 1, len(values) * p // 100)] * 1e3, 3))
+                    for p in [50, 90, 99, 100])
+
+    def getStats(self):
+        with self.lock:
+            return {
+                "uptimeSeconds": round(time.time() - self.started, 1),
+                "requests": self.requests,
+                "errors": self.errors,
+                "batches": self.batches,
+                "meanBatchSize": round(float(self.batched) / self.batches, 2) if self.batches else 0,
+                "latencyMs": self.getPercentiles(self.latencies),
+                "queueMs": self.getPercentiles(self.queueTimes),
+                "renderMs": self.getPercentiles(self.renderTimes),
+            }
+
+
+class StickerBatcher(object):
+    """
+    Collects jobs from the request threads and hands them to the process
+    pool in batches, one chunk of each batch per process; render() blocks
+    the calling thread until its job is done
+    """
+
+    def __init__(self, processes=None, batchSize=16, batchWait=0.005, timeout=30):
+        self.processes = processes or multiprocessing.cpu_count()
+        self.batchSize = batchSize
+        self.batchWait = batchWait
+        self.timeout = timeout
+        self.metrics = StickerMetrics()
+        self.jobs = Queue.Queue()
+        self.pool = multiprocessing.Pool(self.processes)
+
+        self.dispatcher = threading.Thread(target=self.dispatch)
+        self.dispatcher.daemon = True
+        self.dispatcher.start()
+
+    def render(self, request):
+        """(error, bytes, job) for a parsed request"""
+        job = StickerJob(request)
+        self.jobs.put(job)
+
+        if not job.done.wait(self.timeout):
+            job.error = "timed out after %ds" % self.timeout
+
+        return job.error, job.result, job
+
+    def dispatch(self):
+        while True:
+            batch = [self.jobs.get()]
+            deadline = time.time() + self.batchWait
+
+            while len(batch) < self.batchSize:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.jobs.get(timeout=remaining))
+                except Queue.Empty:
+                    break
+
+            self.metrics.addBatch(len(batch))
+
+            # Interleaved chunks, so every process gets work at once
+            chunks = min(self.processes, len(batch))
+            for i in range(chunks):
+                chunk = batch[i::chunks]
+                self.pool.apply_async(renderStickers, ([job.request for job in chunk], ),
+                                      callback=self.getCallback(chunk))
+
+    @staticmethod
+    def getCallback(chunk):
+        def finish(results):
+            for job, (error, result, started, seconds) in zip(chunk, results):
+                job.error = error
+                job.result = result
+                job.started = started
+                job.renderSeconds = seconds
+                job.done.set()
+        return finish
+
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
+
+
+class StickerHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    server_version = "StickerServer/1.0"
+
+    def address_string(self):
+        # Unix socket clients have no address
+        if isinstance(self.client_address, tuple):
+            return self.client_address[0]
+        return "unix"
+
+    def sendBody(self, code, contentType, body, headers=()):
+        self.send_response(code)
+        self.send_header("Content-Type", contentType)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def sendJSON(self, code, data):
+        self.sendBody(code, "application/json", json.dumps(data, sort_keys=True) + "\n")
+
+    def do_GET(self):
+        if self.path == "/metrics":
+            self.sendJSON(200, self.server.batcher.metrics.getStats())
+        else:
+            self.sendJSON(404, {"error": "not found"})
+
+    def do_POST(self):
+        if self.path != "/sticker":
+            self.sendJSON(404, {"error": "not found"})
+            return
+
+        start = time.time()
+        batcher = self.server.batcher
+
+        try:
+            body = self.rfile.read(int(self.headers.getheader("Content-Length", 0)))
+            request = parseRequest(body)
+        except ValueError, e:
+            batcher.metrics.addRequest(str(e), 0.0, 0.0, time.time() - start)
+            self.sendJSON(400, {"error": str(e)})
+            return
+
+        error, result, job = batcher.render(request)
+
+        latency = time.time() - start
+        # Includes the wait behind earlier requests in the same chunk
+        queue = (job.started or time.time()) - job.created
+        batcher.metrics.addRequest(error, queue, job.renderSeconds, latency)
+
+        if error is not None:
+            self.sendJSON(422, {"error": error})
+            return
+
+        self.sendBody(200, CONTENT_TYPES[request["format"]], result, [
+            ("X-Queue-Ms", "%.3f" % (queue * 1e3)),
+            ("X-Render-Ms", "%.3f" % (job.renderSeconds * 1e3)),
+            ("X-Latency-Ms", "%.3f" % (latency * 1e3)),
+        ])
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class ThreadingUnixHTTPServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve schedule stickers over HTTP")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--socket", help="listen on this Unix socket instead")
+    parser.add_argument("--processes", type=int, default=None,
+                        help="encoder processes (default: one per CPU)")
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--batch-wait", type=float, default=5,
+                        help="ms to wait for a batch to fill (default 5)")
+    parser.add_argument("--verbose", action="store_true", help="log every request")
+    args = parser.parse_args()
+
+    # Fork the pool before any server threads exist
+    batcher = StickerBatcher(args.processes, args.batch_size, args.batch_wait / 1e3)
+
+    if args.socket:
+        if os.path.exists(args.socket):
+            os.remove(args.socket)
+        server = ThreadingUnixHTTPServer(args.socket, StickerHandler)
+        where = args.socket
+    else:
+        server = ThreadingHTTPServer((args.host, args.port), StickerHandler)
+        where = "http://%s:%d" % (args.host, args.port)
+
+    server.batcher = batcher
+    server.verbose = args.verbose
+
+    print >> sys.stderr, "Serving stickers on", where
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        batcher.close()
+        if args.socket:
+            os.remove(args.socket)
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
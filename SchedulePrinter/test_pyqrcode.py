@@ -0,0 +1,89 @@
+#
+#	test_pyqrcode.py
+#
+#	Checks that the encoder's optimizations leave its output unchanged
+#
+#	python -m unittest test_pyqrcode
+#
+
+import random
+import unittest
+
+import pyqrcode
+
+LEVELS = [pyqrcode.QRErrorCorrectLevel.L, pyqrcode.QRErrorCorrectLevel.M,
+          pyqrcode.QRErrorCorrectLevel.Q, pyqrcode.QRErrorCorrectLevel.H]
+
+# Both ends of each length field range
+TYPE_NUMBERS = [1, 5, 9, 10, 18, 26, 27, 33, 40]
+
+
+def randomPayloads(seed=0):
+    """
+    (typeNumber, errorCorrectLevel, data): random bytes filling part of a
+    symbol of each of TYPE_NUMBERS at each EC level
+    """
+    rng = random.Random(seed)
+    for typeNumber in TYPE_NUMBERS:
+        for errorCorrectLevel in LEVELS:
+            capacity = pyqrcode.QRRSBlock.getDataCount(typeNumber, errorCorrectLevel) - 3
+            data = "".join(chr(rng.randint(0, 255)) for _ in range(rng.randint(1, capacity)))
+            yield typeNumber, errorCorrectLevel, data
+
+
+class ReedSolomonTest(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = pyqrcode.RS_ENGINE
+        self.getErrorCorrectPolynomial = pyqrcode.QRUtil.getErrorCorrectPolynomial
+
+    def tearDown(self):
+        pyqrcode.RS_ENGINE = self.engine
+        pyqrcode.QRUtil.getErrorCorrectPolynomial = staticmethod(self.getErrorCorrectPolynomial)
+
+    def makeModules(self, typeNumber, errorCorrectLevel, data):
+        return pyqrcode.MakeQR(data, minTypeNumber=typeNumber,
+                               errorCorrectLevel=errorCorrectLevel).modules
+
+    def testSymbolsMatchUncachedPolynomialEngine(self):
+        payloads = list(randomPayloads())
+        cached = [self.makeModules(*payload) for payload in payloads]
+
+        # The original encoder: polynomial division by a generator that is
+        # rebuilt on every call
+        getErrorCorrectPolynomial = self.getErrorCorrectPolynomial
+
+        def getUncachedPolynomial(errorCorrectLength):
+            pyqrcode.QRUtil.RS_POLY_CACHE.clear()
+            return getErrorCorrectPolynomial(errorCorrectLength)
+
+        pyqrcode.RS_ENGINE = "polynomial"
+        pyqrcode.QRUtil.getErrorCorrectPolynomial = staticmethod(getUncachedPolynomial)
+
+        for payload, modules in zip(payloads, cached):
+            self.assertEqual(self.makeModules(*payload), modules,
+                             "version %d level %d" % payload[:2])
+
+
+@unittest.skipIf(pyqrcode.numpy is None, "numpy is not installed")
+class MaskScorerTest(unittest.TestCase):
+
+    def testScorersAgreeOnEveryMask(self):
+        for typeNumber, errorCorrectLevel, data in randomPayloads():
+            qr = pyqrcode.MakeQR(data, minTypeNumber=typeNumber, errorCorrectLevel=errorCorrectLevel)
+
+            n = qr.getModuleCount()
+            masked = pyqrcode.numpy.empty((8, n, n), dtype=pyqrcode.numpy.int32)
+            expected = []
+            for i in range(8):
+                qr.makeImpl(True, i)
+                masked[i].flat = pyqrcode.numpy.frombuffer(qr.modules, dtype=pyqrcode.numpy.uint8)
+                expected.append(pyqrcode.QRUtil.getLostPoint(qr))
+
+            # Equal scores for every mask, so both pick the same one
+            self.assertEqual([int(score) for score in pyqrcode.QRUtil.getLostPoints(masked)],
+                             expected, "version %d level %d" % (typeNumber, errorCorrectLevel))
+
+
+if __name__ == "__main__":
+    unittest.main()